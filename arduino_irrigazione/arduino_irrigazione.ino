@@ -44,7 +44,7 @@ void callback(char* topic, byte* payload, unsigned int length) {
     Serial.println("Received payload: " + message);
 
     // JSON Parsing
-    StaticJsonDocument<200> doc;
+    StaticJsonDocument<256> doc;
     DeserializationError error = deserializeJson(doc, message);
 
     if (error) {
@@ -52,18 +52,19 @@ void callback(char* topic, byte* payload, unsigned int length) {
         return;
     }
 
-    // Extract smartpot_id and action
+    // Extract smartpot_id, action and the correlation_id to echo in the confirmation
     String received_smartpot_id = doc["smartpot_id"];
     String action = doc["action"];
+    String correlation_id = doc["correlation_id"] | "";
 
     // Check if the message corresponds to one of the SmartPots and activate the correct relay
     if (action.equals("start")) {
         if (received_smartpot_id.equals("Strawberry")) {
             Serial.println("Starting irrigation for Strawberry");
-            irrigate(RELAY_STRAWBERRY, "Strawberry");
+            irrigate(RELAY_STRAWBERRY, "Strawberry", correlation_id);
         } else if (received_smartpot_id.equals("Basil")) {
             Serial.println("Starting irrigation for Basil");
-            irrigate(RELAY_BASIL, "Basil");
+            irrigate(RELAY_BASIL, "Basil", correlation_id);
         } else {
             Serial.println("Error: Unrecognized SmartPot!");
         }
@@ -71,21 +72,24 @@ void callback(char* topic, byte* payload, unsigned int length) {
 }
 
 // Activates the irrigation for a given relay and sends a confirmation message.
-void irrigate(int relay_pin, String smartpot) {
+void irrigate(int relay_pin, String smartpot, String correlation_id) {
     digitalWrite(relay_pin, LOW);  // Turns on the pump
     delay(1000);  // Keeps it on for 1 second
     digitalWrite(relay_pin, HIGH);  // Turns off the pump
     Serial.println("Irrigation completed for " + smartpot);
 
     // Send confirmation message via MQTT
-    send_confirmation(smartpot);
+    send_confirmation(smartpot, correlation_id);
 }
 
-// Publishes an MQTT message to confirm irrigation completion.
-void send_confirmation(String smartpot) {
+// Publishes an MQTT message to confirm irrigation completion, echoing the command's correlation_id.
+void send_confirmation(String smartpot, String correlation_id) {
     StaticJsonDocument<200> doc;
     doc["smartpot_id"] = smartpot;
     doc["status"] = "done";
+    if (correlation_id.length() > 0) {
+        doc["correlation_id"] = correlation_id;
+    }
 
     char buffer[256];
     serializeJson(doc, buffer);
@@ -11,10 +11,11 @@ load_dotenv()
 
 BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
 AWS_GATEWAY_URL = os.environ.get('AWS_GATEWAY_URL', '')
+REPORTS_PAGE_SIZE = 5  # Reports downloaded per getAllReports request
 
 bot = telebot.TeleBot(BOT_TOKEN)
 
-def fetch_data(endpoint: str, method="GET", payload=None):
+def fetch_data(endpoint: str, method="GET", payload=None, params=None):
     """Helper function to make HTTP requests (GET/POST)."""
     url = f'{AWS_GATEWAY_URL}{endpoint}'
     headers = {'Content-Type': 'application/json'}
@@ -22,10 +23,25 @@ def fetch_data(endpoint: str, method="GET", payload=None):
     if method == "POST":
         response = requests.post(url, json=payload, headers=headers)
     else:
-        response = requests.get(url, headers=headers)
+        response = requests.get(url, headers=headers, params=params)
     
     return response.json() if response.status_code == 200 else None
 
+def fetch_report_pages(only_names: bool, page_size: int):
+    """Pages through getAllReports, yielding the reports of each page."""
+    cursor = None
+    while True:
+        params = {"onlyNames": str(only_names).lower(), "limit": page_size}
+        if cursor:
+            params["cursor"] = cursor
+        data = fetch_data("getAllReports", params=params)
+        if not data:
+            return
+        yield data["reports"]
+        cursor = data.get("nextCursor")
+        if not cursor:
+            return
+
 # Get Latest Data
 def get_latest_data(message: telebot.types.Message):
     data = fetch_data("getLatestData")
@@ -44,19 +60,20 @@ def get_latest_data(message: telebot.types.Message):
 
 # Get All Reports (Scarica tutti i report)
 def get_all_reports(message: telebot.types.Message):
-    data = fetch_data("getAllReports?onlyNames=false")
-    if data:
-        for report in data:
+    sent = 0
+    for reports in fetch_report_pages(only_names=False, page_size=REPORTS_PAGE_SIZE):
+        for report in reports:
             file = io.BytesIO(report["bytes"].encode('utf-8'))
             file.name = report["key"]
             bot.send_document(message.chat.id, file)
-    else:
+            sent += 1
+    if not sent:
         bot.send_message(message.chat.id, "❌ No reports found.")
     send_welcome(message)
 
 # Get Report (Show only report's names and ask the number)
 def get_report_list(message: telebot.types.Message):
-    data = fetch_data("getAllReports?onlyNames=true")
+    data = [report for reports in fetch_report_pages(only_names=True, page_size=1000) for report in reports]
     if data:
         daily_reports = [r["key"] for r in data if r["type"] == "daily"]
         manual_reports = [r["key"] for r in data if r["type"] == "manual"]
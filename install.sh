@@ -24,6 +24,14 @@ echo "Default AWS region: $region"
 echo "Creating S3 bucket: $S3_BUCKET"
 awslocal s3api create-bucket --bucket $S3_BUCKET
 
+# **Expiring cached report windows after 30 days and raw data after RAW_RETENTION_DAYS (default 90)**
+awslocal s3api put-bucket-lifecycle-configuration --bucket $S3_BUCKET \
+    --lifecycle-configuration '{"Rules": [{"ID": "expire-report-cache", "Filter": {"Prefix": "cache/"}, "Status": "Enabled", "Expiration": {"Days": 30}}, {"ID": "expire-raw-data", "Filter": {"Prefix": "raw/"}, "Status": "Enabled", "Expiration": {"Days": '"${RAW_RETENTION_DAYS:-90}"'}}]}'
+
+# **Uploading plant limits configuration**
+echo "Uploading plant limits configuration"
+awslocal s3 cp ./config/plant_limits.json s3://$S3_BUCKET/config/plant_limits.json
+
 # **Creating DynamoDB Table**
 echo "Creating DynamoDB table: $DYNAMODB_TABLE"
 awslocal dynamodb create-table \
@@ -33,16 +41,46 @@ awslocal dynamodb create-table \
     --provisioned-throughput ReadCapacityUnits=1,WriteCapacityUnits=1 \
     --region $region
 
+# **Creating DynamoDB Rollups Table**
+echo "Creating DynamoDB table: ${DYNAMODB_ROLLUPS_TABLE:-SmartPotRollups}"
+awslocal dynamodb create-table \
+    --table-name ${DYNAMODB_ROLLUPS_TABLE:-SmartPotRollups} \
+    --attribute-definitions AttributeName=smartpot_id,AttributeType=S AttributeName=hour,AttributeType=S \
+    --key-schema AttributeName=smartpot_id,KeyType=HASH AttributeName=hour,KeyType=RANGE \
+    --provisioned-throughput ReadCapacityUnits=1,WriteCapacityUnits=1 \
+    --region $region
+
+# **Creating DynamoDB Reports Catalog Table**
+echo "Creating DynamoDB table: ${DYNAMODB_REPORTS_TABLE:-SmartPotReports}"
+awslocal dynamodb create-table \
+    --table-name ${DYNAMODB_REPORTS_TABLE:-SmartPotReports} \
+    --attribute-definitions AttributeName=report_name,AttributeType=S \
+    --key-schema AttributeName=report_name,KeyType=HASH \
+    --provisioned-throughput ReadCapacityUnits=1,WriteCapacityUnits=1 \
+    --region $region
+
 # **Creating SQS Queues**
 echo "Creating SQS queues"
 SmartPotQueueURL=$(awslocal sqs create-queue --queue-name $SQS_IRRIGATION_QUEUE --region $region | jq -r '.QueueUrl')
 SmartPotQueueARN=$(awslocal sqs get-queue-attributes --queue-url $SmartPotQueueURL --attribute-name QueueArn | jq -r '.Attributes.QueueArn')
 echo "SmartPotQueueARN: $SmartPotQueueARN"
 
+# Le richieste di irrigazione ricevute 3 volte (IRRIGATION_MAX_RECEIVES di irrigateNow) finiscono nella DLQ
+IrrigationDLQURL=$(awslocal sqs create-queue --queue-name $SQS_IRRIGATION_QUEUE-dlq --region $region | jq -r '.QueueUrl')
+IrrigationDLQARN=$(awslocal sqs get-queue-attributes --queue-url $IrrigationDLQURL --attribute-name QueueArn | jq -r '.Attributes.QueueArn')
+awslocal sqs set-queue-attributes --queue-url $SmartPotQueueURL \
+    --attributes '{"VisibilityTimeout": "60", "RedrivePolicy": "{\"deadLetterTargetArn\":\"'"$IrrigationDLQARN"'\",\"maxReceiveCount\":\"3\"}"}'
+
 AlertsQueueURL=$(awslocal sqs create-queue --queue-name $SQS_ALERTS_QUEUE --region $region | jq -r '.QueueUrl')
 AlertsQueueARN=$(awslocal sqs get-queue-attributes --queue-url $AlertsQueueURL --attribute-name QueueArn | jq -r '.Attributes.QueueArn')
 echo "AlertsQueueARN: $AlertsQueueARN"
 
+# Gli avvisi non consegnati dopo 5 ricezioni (es. Telegram irraggiungibile a lungo) finiscono nella DLQ
+AlertsDLQURL=$(awslocal sqs create-queue --queue-name $SQS_ALERTS_QUEUE-dlq --region $region | jq -r '.QueueUrl')
+AlertsDLQARN=$(awslocal sqs get-queue-attributes --queue-url $AlertsDLQURL --attribute-name QueueArn | jq -r '.Attributes.QueueArn')
+awslocal sqs set-queue-attributes --queue-url $AlertsQueueURL \
+    --attributes '{"VisibilityTimeout": "60", "RedrivePolicy": "{\"deadLetterTargetArn\":\"'"$AlertsDLQARN"'\",\"maxReceiveCount\":\"5\"}"}'
+
 # **Creating Kinesis Stream**
 echo "Creating Kinesis stream: $KINESIS_STREAM"
 awslocal kinesis create-stream --stream-name $KINESIS_STREAM --shard-count 1 --region $region
@@ -62,6 +100,15 @@ echo "Creating Lambda Functions"
 
 mkdir -p ./tmpZips
 
+# Timeout (secondi) delle Lambda che attendono servizi esterni, 3 secondi per le altre.
+# irrigateNow: connessione MQTT (5) + IRRIGATION_CONFIRM_TIMEOUT (10) + margine (2), arrotondato
+# handleAlerts: un batch di 5 avvisi con TELEGRAM_BURST=3 e TELEGRAM_RATE=1 richiede ~2s di token,
+# più i tentativi (backoff 1+2+4s) e il margine (3s); oltre la scadenza gli avvisi tornano a SQS
+declare -A lambda_timeouts=(
+    ["irrigateNow"]=20
+    ["handleAlerts"]=30
+)
+
 declare -A lambda_functions=(
     ["processSensorData"]="processSensorData"
     ["handleAlerts"]="handleAlerts"
@@ -100,7 +147,8 @@ for function in "${!lambda_functions[@]}"; do
             --handler $function.lambda_handler \
             --runtime python3.12 \
             --role $RoleARN \
-            --environment "Variables={TELEGRAM_BOT_TOKEN=$TELEGRAM_BOT_TOKEN,TELEGRAM_CHAT_ID=$TELEGRAM_CHAT_ID}" \
+            --environment "Variables={TELEGRAM_BOT_TOKEN=$TELEGRAM_BOT_TOKEN,TELEGRAM_CHAT_ID=$TELEGRAM_CHAT_ID,EVENT_AUDIT_LOG=${EVENT_AUDIT_LOG:-false}}" \
+            --timeout ${lambda_timeouts[$function]} \
             --no-cli-pager
     else
         # ✅ Crea le altre Lambda SENZA le variabili Telegram
@@ -109,6 +157,7 @@ for function in "${!lambda_functions[@]}"; do
             --handler $function.lambda_handler \
             --runtime python3.12 \
             --role $RoleARN \
+            --timeout ${lambda_timeouts[$function]:-3} \
             --no-cli-pager
     fi
 done
@@ -125,12 +174,14 @@ awslocal lambda create-event-source-mapping \
 awslocal lambda create-event-source-mapping \
     --function-name handleAlerts \
     --event-source-arn $AlertsQueueARN \
-    --batch-size 5
+    --batch-size 5 \
+    --function-response-types ReportBatchItemFailures
 
 awslocal lambda create-event-source-mapping \
     --function-name irrigateNow \
     --event-source-arn $SmartPotQueueARN \
-    --batch-size 5
+    --batch-size 5 \
+    --function-response-types ReportBatchItemFailures
 
 # **Creating EventBridge Rule for Daily Report**
 echo "Creating EventBridge Rule for Daily Report"
@@ -152,9 +203,29 @@ awslocal events put-targets \
     --targets file://targets/target_report.json \
     --region $region
 
+# **Creating EventBridge Rule for Alert Digests**
+echo "Creating EventBridge Rule for Alert Digests"
+
+awslocal events put-rule \
+    --name scheduled-alert-digest \
+    --schedule-expression 'rate(5 minutes)' \
+    --region $region
+
+awslocal lambda add-permission \
+    --function-name handleAlerts \
+    --statement-id scheduled-alert-digest-event \
+    --action 'lambda:InvokeFunction' \
+    --principal events.amazonaws.com \
+    --source-arn arn:aws:events:$region:000000000000:rule/scheduled-alert-digest
+
+awslocal events put-targets \
+    --rule scheduled-alert-digest \
+    --targets file://targets/target_alert_digest.json \
+    --region $region
+
 # Create API Gateway
 echo "Creating API Gateway"
-output_api=$(awslocal apigateway create-rest-api --name 'SmartPotSystem API Gateway' --region $region)
+output_api=$(awslocal apigateway create-rest-api --name 'SmartPotSystem API Gateway' --binary-media-types 'application/gzip' --region $region)
 api_id=$(echo $output_api | jq -r '.id')
 
 output_parent=$(awslocal apigateway get-resources --rest-api-id $api_id --region $region)
@@ -1,113 +1,277 @@
 import json
 import os
+import struct
+import sys
 import time
-from datetime import datetime
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import boto3
+from botocore.config import Config
 
 # Load environment variables
 LOCALSTACK_HOSTNAME = os.getenv("LOCALSTACK_HOSTNAME", "localhost")
 EDGE_PORT = os.getenv("EDGE_PORT", "4566")
 AWS_REGION = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
 
+# Number of raw files downloaded and parsed concurrently
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "16"))
+
 # AWS Clients
 ENDPOINT_URL = f"http://{LOCALSTACK_HOSTNAME}:{EDGE_PORT}"
-s3 = boto3.client("s3", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
+s3 = boto3.client("s3", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION,
+                  config=Config(max_pool_connections=REPORT_WORKERS))
 sqs = boto3.client("sqs", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
+dynamodb = boto3.client("dynamodb", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION,
+                        config=Config(max_pool_connections=REPORT_WORKERS))
 
 # Configurations
 S3_BUCKET = os.getenv("S3_BUCKET", "smartpotsystem-s3-bucket")
 SQS_ALERTS_QUEUE = os.getenv("SQS_ALERTS_QUEUE", "SmartPotAlertsQueue")
+DYNAMODB_TABLE = os.getenv("DYNAMODB_TABLE", "SmartPotData")
+DYNAMODB_ROLLUPS_TABLE = os.getenv("DYNAMODB_ROLLUPS_TABLE", "SmartPotRollups")
+DYNAMODB_REPORTS_TABLE = os.getenv("DYNAMODB_REPORTS_TABLE", "SmartPotReports")
 RAW_FOLDER = "raw/"
 REPORT_FOLDER = "reports/daily/"
-EVENTS_FOLDER = "events/"
+REPORT_TYPE = "daily"
+METRICS = ["temperature", "humidity", "soil_moisture"]
+
+# Report fields filled from the event_<issue> counters of the hourly rollups
+EVENT_FIELDS = {
+    "sensor_error": "sensor_errors",
+    "temperature_high": "temperature_high",
+    "temperature_low": "temperature_low",
+    "humidity_high": "humidity_high",
+    "humidity_low": "humidity_low",
+    "soil_moisture_high": "soil_moisture_high",
+    "irrigation_completed": "irrigation_completed",
+    "irrigation_error": "irrigation_error"
+}
+
+# Columnar raw segments: magic, pot id length, row count, first and last timestamp
+SEGMENT_MAGIC = b"SPC1"
+SEGMENT_HEADER = struct.Struct("<4sHIqq")
+S3_DELETE_BATCH_SIZE = 1000  # Maximum number of keys accepted by delete_objects
 
-def calculate_average(values):
-    """Computes the average of valid numerical values, ignoring 'ERR' values.
+def calculate_average(aggregate):
+    """Computes the average from a [count, sum] aggregate.
        Returns None if there are no valid values."""
 
-    numeric_values = [float(v) for v in values if v != "ERR"]
-    return round(sum(numeric_values) / len(numeric_values), 2) if numeric_values else None
+    count, total = aggregate
+    return round(total / count, 2) if count else None
 
-def delete_s3_folder(prefix):
-    """Deletes all objects in a specific S3 folder (used to clear raw data after generating daily reports)."""
-    
-    objects = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=prefix)
-    if "Contents" in objects:
-        delete_keys = [{"Key": obj["Key"]} for obj in objects["Contents"]]
-        s3.delete_objects(Bucket=S3_BUCKET, Delete={"Objects": delete_keys})
+def list_s3_keys(prefix):
+    """Lists every key stored under a prefix, following list_objects_v2 pagination."""
 
-def get_event_data(smartpot_id):
-    """Retrieves all event timestamps from S3 for a specific SmartPot."""
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        for content in page.get("Contents", []):
+            yield content["Key"]
 
-    event_file_path = f"{EVENTS_FOLDER}daily_events_{smartpot_id}.json"
+def is_hour_partition(name):
+    """True if a folder name under raw/<date>/ is an hourly partition (HH)."""
 
-    try:
-        obj = s3.get_object(Bucket=S3_BUCKET, Key=event_file_path)
-        event_records = json.loads(obj["Body"].read().decode("utf-8"))
-    except s3.exceptions.NoSuchKey:
-        print(f"No event file found for {smartpot_id}. Returning empty list.")
-        event_records = []
-
-    # Aggrega gli eventi in base al tipo
-    event_counts = {
-        "sensor_errors": 0,
-        "temperature_high": 0,
-        "temperature_low": 0,
-        "humidity_high": 0,
-        "humidity_low": 0,
-        "soil_moisture_high": 0,
-        "irrigation_completed": 0,
-        "irrigation_error": 0
+    return len(name) == 2 and name.isdigit()
+
+def list_legacy_raw_keys():
+    """Lists the raw objects stored with the layouts that predate the hourly partitions
+       (raw/<date>/<smartpot_id>.json and raw/<date>/<smartpot_id>/<sequence>.jsonl|.spc).
+       The hourly partitions raw/<date>/<HH>/ are skipped: manual reports read them for the partial hours
+       of their windows, and the bucket lifecycle expires them after RAW_RETENTION_DAYS."""
+
+    paginator = s3.get_paginator("list_objects_v2")
+    for date_page in paginator.paginate(Bucket=S3_BUCKET, Prefix=RAW_FOLDER, Delimiter="/"):
+        for date_prefix in date_page.get("CommonPrefixes", []):
+            prefix = date_prefix["Prefix"]
+            for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix, Delimiter="/"):
+                for content in page.get("Contents", []):
+                    yield content["Key"]
+                for folder in page.get("CommonPrefixes", []):
+                    if not is_hour_partition(folder["Prefix"][len(prefix):-1]):
+                        yield from list_s3_keys(folder["Prefix"])
+
+def decode_columnar_segment(body):
+    """Decodes a columnar raw segment (.spc) written by processSensorData.
+       The columns are memoryviews over the decompressed block, so their values are never copied.
+       Returns a dict with smartpot_id, the first and last timestamp, the timestamps column
+       (seconds since the epoch of the local measure_date) and one column per metric."""
+
+    magic, id_length, rows, first_timestamp, last_timestamp = SEGMENT_HEADER.unpack_from(body)
+    if magic != SEGMENT_MAGIC:
+        raise ValueError("Invalid columnar raw segment")
+
+    offset = SEGMENT_HEADER.size
+    smartpot_id = bytes(body[offset:offset + id_length]).decode("utf-8")
+    block = memoryview(zlib.decompress(memoryview(body)[offset + id_length:]))
+    column_size = rows * 8
+
+    columns = []
+    for index, typecode in enumerate(["q"] + ["d"] * len(METRICS)):
+        column = block[index * column_size:(index + 1) * column_size]
+        if sys.byteorder != "little":
+            column = array(typecode, column.tobytes())
+            column.byteswap()
+            columns.append(column)
+        else:
+            columns.append(column.cast(typecode))
+
+    segment = {
+        "smartpot_id": smartpot_id,
+        "first_timestamp": first_timestamp,
+        "last_timestamp": last_timestamp,
+        "timestamps": columns[0]
+    }
+    segment.update(zip(METRICS, columns[1:]))
+    return segment
+
+def load_raw_records(file_key, body):
+    """Parses a raw data object downloaded from S3.
+       Supports both JSON Lines segments (.jsonl, one reading per line)
+       and legacy daily files (.json, a single array of readings)."""
+
+    if file_key.endswith(".jsonl"):
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+    return json.loads(body)
+
+def get_smartpot_ids():
+    """Lists the SmartPots registered in the latest-value DynamoDB table (paginated, keys only)."""
+
+    smartpot_ids = []
+    paginator = dynamodb.get_paginator("scan")
+    for page in paginator.paginate(TableName=DYNAMODB_TABLE, ProjectionExpression="smartpot_id"):
+        smartpot_ids.extend(item["smartpot_id"]["S"] for item in page.get("Items", []))
+    return smartpot_ids
+
+def get_rollups(smartpot_id, start_time, end_time):
+    """Retrieves and merges the hourly rollups of a SmartPot with start_time <= hour < end_time
+       with a single query (at most 24 items are read for a daily report).
+       Returns ({metric: [count, sum]}, {event field: count}) from the metrics and the event counters."""
+
+    aggregates = {metric: [0, 0.0] for metric in METRICS}
+    event_counts = {field: 0 for field in EVENT_FIELDS.values()}
+    paginator = dynamodb.get_paginator("query")
+    for page in paginator.paginate(
+        TableName=DYNAMODB_ROLLUPS_TABLE,
+        KeyConditionExpression="smartpot_id = :p AND #hour BETWEEN :start AND :end",
+        ExpressionAttributeNames={"#hour": "hour"},
+        ExpressionAttributeValues={
+            ":p": {"S": smartpot_id},
+            ":start": {"S": start_time.strftime("%Y-%m-%d %H")},
+            ":end": {"S": (end_time - timedelta(hours=1)).strftime("%Y-%m-%d %H")}
+        }
+    ):
+        for item in page.get("Items", []):
+            for metric in METRICS:
+                if metric in item:
+                    aggregates[metric][0] += int(item[metric]["M"]["count"]["N"])
+                    aggregates[metric][1] += float(item[metric]["M"]["sum"]["N"])
+            for event_type, field in EVENT_FIELDS.items():
+                if f"event_{event_type}" in item:
+                    event_counts[field] += int(item[f"event_{event_type}"]["N"])
+    return aggregates, event_counts
+
+def aggregate_rollups(start_time, end_time):
+    """Builds the report aggregates and event counts from the hourly rollups of every registered SmartPot.
+       Returns ({smartpot_id: {metric: [count, sum]}}, {smartpot_id: {event field: count}}),
+       leaving out of the aggregates the SmartPots without sensor data."""
+
+    smartpot_ids = get_smartpot_ids()
+    with ThreadPoolExecutor(max_workers=REPORT_WORKERS) as executor:
+        rollups = list(executor.map(lambda smartpot_id: get_rollups(smartpot_id, start_time, end_time), smartpot_ids))
+
+    report_data = {
+        smartpot_id: aggregates
+        for smartpot_id, (aggregates, _) in zip(smartpot_ids, rollups)
+        if any(count for count, _ in aggregates.values())
     }
+    event_data_by_pot = {smartpot_id: event_counts for smartpot_id, (_, event_counts) in zip(smartpot_ids, rollups)}
+    return report_data, event_data_by_pot
+
+def aggregate_raw_file(file_key):
+    """Downloads and parses a raw data file from S3 (columnar .spc segment, .jsonl segment or legacy .json file).
+       Returns its partial aggregates grouped by SmartPot: {smartpot_id: {metric: [count, sum]}},
+       ignoring 'ERR' values."""
+
+    file_obj = s3.get_object(Bucket=S3_BUCKET, Key=file_key)
+    body = file_obj["Body"].read()
+
+    if file_key.endswith(".spc"):
+        segment = decode_columnar_segment(body)
+        return {segment["smartpot_id"]: {metric: [len(segment[metric]), sum(segment[metric])] for metric in METRICS}}
+
+    data = load_raw_records(file_key, body.decode("utf-8"))
+
+    partial = {}
+    for record in data:
+        smartpot_id = record.get("smartpot_id")
+        if not smartpot_id:
+            continue
+
+        aggregates = partial.setdefault(smartpot_id, {metric: [0, 0.0] for metric in METRICS})
+        for metric in METRICS:
+            if metric in record and record[metric] != "ERR":
+                aggregates[metric][0] += 1
+                aggregates[metric][1] += float(record[metric])
+    return partial
 
-    for event in event_records:
-        event_type = event.get("event_type")
-        if event_type in event_counts:
-            event_counts[event_type] += 1
+def merge_aggregates(report_data, partial):
+    """Merges the partial aggregates of one raw file into the report aggregates."""
 
-    return event_counts
+    for smartpot_id, aggregates in partial.items():
+        merged = report_data.setdefault(smartpot_id, {metric: [0, 0.0] for metric in METRICS})
+        for metric in METRICS:
+            merged[metric][0] += aggregates[metric][0]
+            merged[metric][1] += aggregates[metric][1]
+
+def delete_s3_keys(keys):
+    """Deletes the given S3 objects, in batches of S3_DELETE_BATCH_SIZE keys."""
+
+    delete_keys = [{"Key": key} for key in keys]
+    for start in range(0, len(delete_keys), S3_DELETE_BATCH_SIZE):
+        s3.delete_objects(Bucket=S3_BUCKET, Delete={"Objects": delete_keys[start:start + S3_DELETE_BATCH_SIZE]})
+
+def register_report(report_key, body):
+    """Registers a stored report in the reports catalog, so getReport can find it with a single point read."""
+
+    try:
+        dynamodb.put_item(
+            TableName=DYNAMODB_REPORTS_TABLE,
+            Item={
+                "report_name": {"S": report_key.rsplit("/", 1)[-1]},
+                "report_key": {"S": report_key},
+                "report_type": {"S": REPORT_TYPE},
+                "size": {"N": str(len(body.encode("utf-8")))},
+                "created_at": {"S": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+            }
+        )
+    except Exception as e:
+        print(f"Error registering report {report_key} in the catalog: {e}")
 
 def generate_daily_report():
-    """Generates a daily report based on the raw data available in S3, grouped by SmartPot."""
+    """Generates a daily report grouped by SmartPot.
+       Averages and event counts come from the hourly rollups of the last 24 complete hours.
+       Raw files in the legacy layouts hold readings stored before the rollups existed, so they are always
+       merged into the report too (they are never counted twice) and deleted only after being reported;
+       the hourly raw partitions are never deleted here."""
     
     current_date = datetime.now().strftime("%Y-%m-%d")
-    report_data = {}
+    window_end = datetime.now().replace(minute=0, second=0, microsecond=0)
+    window_start = window_end - timedelta(hours=24)
 
-    # Retrieve all RAW files from S3
-    raw_files = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=RAW_FOLDER)
-    if "Contents" not in raw_files:
-        return False  # Indica che il report non è stato generato
+    # Retrieve the RAW files stored before the hourly partitions (every page of the listing)
+    raw_files = [key for key in list_legacy_raw_keys() if key.endswith((".json", ".jsonl", ".spc"))]
 
-    # Process each raw data file
-    for file in raw_files["Contents"]:
-        file_key = file["Key"]
-        if not file_key.endswith(".json"):
-            continue
+    # Merge at most 24 hourly rollups per SmartPot (sensor data and event counters)
+    report_data, event_data_by_pot = aggregate_rollups(window_start, window_end)
+
+    if not report_data and not raw_files:
+        return False  # Indica che il report non è stato generato
 
-        # Download file from S3
-        file_obj = s3.get_object(Bucket=S3_BUCKET, Key=file_key)
-        data = json.loads(file_obj["Body"].read().decode("utf-8"))
-
-        # Process sensor data grouped by smartpot_id
-        for record in data:
-            smartpot_id = record.get("smartpot_id")
-            if not smartpot_id:
-                continue
-
-            if smartpot_id not in report_data:
-                report_data[smartpot_id] = {
-                    "smartpot_id": smartpot_id,
-                    "temperature": [],
-                    "humidity": [],
-                    "soil_moisture": []
-                }
-
-            if "temperature" in record:
-                report_data[smartpot_id]["temperature"].append(float(record["temperature"]))
-            if "humidity" in record:
-                report_data[smartpot_id]["humidity"].append(float(record["humidity"]))
-            if "soil_moisture" in record:
-                report_data[smartpot_id]["soil_moisture"].append(float(record["soil_moisture"]))
+    # Download and aggregate the legacy raw files concurrently, then merge the partial results
+    with ThreadPoolExecutor(max_workers=REPORT_WORKERS) as executor:
+        for partial in executor.map(aggregate_raw_file, raw_files):
+            merge_aggregates(report_data, partial)
 
     if not report_data:
         alert_message = {
@@ -128,19 +292,20 @@ def generate_daily_report():
             "avg_soil_moisture": calculate_average(data["soil_moisture"]),
         }
 
-        # Retrieve and include event data
-        event_data = get_event_data(smartpot_id)
-        report_entry.update(event_data)
+        # Include event data
+        report_entry.update(event_data_by_pot.get(smartpot_id, {field: 0 for field in EVENT_FIELDS.values()}))
         
         final_report.append(report_entry)
 
     # Save the report to S3
     report_filename = f"{REPORT_FOLDER}daily_report_{current_date}.json"
+    report_body = json.dumps(final_report, indent=4)
     s3.put_object(
         Bucket=S3_BUCKET,
         Key=report_filename,
-        Body=json.dumps(final_report, indent=4)
+        Body=report_body
     )
+    register_report(report_filename, report_body)
 
     # Send notification via handleAlerts
     alert_message = {
@@ -150,9 +315,8 @@ def generate_daily_report():
     }
     sqs.send_message(QueueUrl=SQS_ALERTS_QUEUE, MessageBody=json.dumps(alert_message))
 
-    # Delete all raw data and event records
-    delete_s3_folder(RAW_FOLDER)
-    delete_s3_folder(EVENTS_FOLDER)
+    # Delete the processed legacy raw data (the hourly partitions are expired by the bucket lifecycle)
+    delete_s3_keys(raw_files)
 
     return True  # Indica che il report è stato generato
 
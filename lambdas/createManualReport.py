@@ -1,152 +1,481 @@
 import json
 import os
+import struct
+import sys
+import threading
 import time
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import boto3
+from botocore.config import Config
 
 # Load environment variables
 LOCALSTACK_HOSTNAME = os.getenv("LOCALSTACK_HOSTNAME", "localhost")
 EDGE_PORT = os.getenv("EDGE_PORT", "4566")
 AWS_REGION = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
 
+# Number of SmartPot reports generated concurrently for "All" requests
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "16"))
+
 # AWS Clients
 ENDPOINT_URL = f"http://{LOCALSTACK_HOSTNAME}:{EDGE_PORT}"
-s3 = boto3.client("s3", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
+s3 = boto3.client("s3", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION,
+                  config=Config(max_pool_connections=2 * REPORT_WORKERS))
 sqs = boto3.client("sqs", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
+dynamodb = boto3.client("dynamodb", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION,
+                        config=Config(max_pool_connections=REPORT_WORKERS))
 
 # Configurations
 S3_BUCKET = os.getenv("S3_BUCKET", "smartpotsystem-s3-bucket")
 SQS_ALERTS_QUEUE = os.getenv("SQS_ALERTS_QUEUE")
+DYNAMODB_TABLE = os.getenv("DYNAMODB_TABLE", "SmartPotData")
+DYNAMODB_ROLLUPS_TABLE = os.getenv("DYNAMODB_ROLLUPS_TABLE", "SmartPotRollups")
+DYNAMODB_REPORTS_TABLE = os.getenv("DYNAMODB_REPORTS_TABLE", "SmartPotReports")
 RAW_FOLDER = "raw/"
 REPORT_FOLDER = "reports/manual/"
-
-def calculate_average(values):
-    """Computes the average value from a list while ignoring 'ERR' values.
+REPORT_TYPE = "manual"
+METRICS = ["temperature", "humidity", "soil_moisture"]
+
+# Report fields filled from the event_<issue> counters of the hourly rollups
+EVENT_FIELDS = {
+    "sensor_error": "sensor_errors",
+    "temperature_high": "temperature_high",
+    "temperature_low": "temperature_low",
+    "humidity_high": "humidity_high",
+    "humidity_low": "humidity_low",
+    "soil_moisture_high": "soil_moisture_high",
+    "irrigation_completed": "irrigation_completed",
+    "irrigation_error": "irrigation_error"
+}
+
+# Report cache: closed parts of a window are computed once and reused
+REPORT_CACHE_FOLDER = "cache/manual/"
+REPORT_CACHE_VERSION = 4  # Bump when the aggregation logic changes, to invalidate every cached window
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "256"))
+REPORT_CACHE_GRACE = int(os.getenv("REPORT_CACHE_GRACE", "300"))  # Seconds before data is considered final
+
+# Warm-container LRU cache of report windows, backed by S3
+report_cache = OrderedDict()
+report_cache_lock = threading.Lock()
+
+# Raw segments of a partition are downloaded concurrently (leaf tasks only, so the pool never waits on itself)
+segment_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS)
+
+# Columnar raw segments: magic, pot id length, row count, first and last timestamp
+SEGMENT_MAGIC = b"SPC1"
+SEGMENT_HEADER = struct.Struct("<4sHIqq")
+EPOCH = datetime(1970, 1, 1)
+
+def calculate_average(aggregate):
+    """Computes the average from a [count, sum] aggregate.
        Returns None if there are no valid values."""
 
-    numeric_values = [v for v in values if isinstance(v, (int, float))]
-    return round(sum(numeric_values) / len(numeric_values), 2) if numeric_values else None
-
-def get_event_data(smartpot_id, start_time, end_time):
-    """Retrieves event data from S3 for a given SmartPot and time range.
-       Filters events like sensor errors, temperature/humidity alerts, and irrigation status.
-       Returns a dictionary with event counts."""
+    count, total = aggregate
+    return round(total / count, 2) if count else None
+
+def get_smartpot_ids():
+    """Lists the SmartPots registered in the latest-value DynamoDB table (paginated, keys only)."""
+
+    smartpot_ids = []
+    paginator = dynamodb.get_paginator("scan")
+    for page in paginator.paginate(TableName=DYNAMODB_TABLE, ProjectionExpression="smartpot_id"):
+        smartpot_ids.extend(item["smartpot_id"]["S"] for item in page.get("Items", []))
+    return sorted(smartpot_ids)
+
+def get_rollups(smartpot_id, start_time, end_time):
+    """Retrieves the hourly rollup items of a SmartPot with start_time <= hour < end_time in a single query.
+       Returns a list of (hour, item) pairs, with hour as a datetime."""
+
+    rollups = []
+    paginator = dynamodb.get_paginator("query")
+    for page in paginator.paginate(
+        TableName=DYNAMODB_ROLLUPS_TABLE,
+        KeyConditionExpression="smartpot_id = :p AND #hour BETWEEN :start AND :end",
+        ExpressionAttributeNames={"#hour": "hour"},
+        ExpressionAttributeValues={
+            ":p": {"S": smartpot_id},
+            ":start": {"S": start_time.strftime("%Y-%m-%d %H")},
+            ":end": {"S": (end_time - timedelta(hours=1)).strftime("%Y-%m-%d %H")}
+        }
+    ):
+        for item in page.get("Items", []):
+            rollups.append((datetime.strptime(item["hour"]["S"], "%Y-%m-%d %H"), item))
+    return rollups
+
+def get_rollup_versions(smartpot_id, start_time, end_time):
+    """Retrieves the versions of the hourly rollups of a SmartPot with start_time <= hour < end_time,
+       reading only their keys and version attributes. Returns {hour: version}."""
+
+    versions = {}
+    paginator = dynamodb.get_paginator("query")
+    for page in paginator.paginate(
+        TableName=DYNAMODB_ROLLUPS_TABLE,
+        KeyConditionExpression="smartpot_id = :p AND #hour BETWEEN :start AND :end",
+        ProjectionExpression="#hour, #version",
+        ExpressionAttributeNames={"#hour": "hour", "#version": "version"},
+        ExpressionAttributeValues={
+            ":p": {"S": smartpot_id},
+            ":start": {"S": start_time.strftime("%Y-%m-%d %H")},
+            ":end": {"S": (end_time - timedelta(hours=1)).strftime("%Y-%m-%d %H")}
+        }
+    ):
+        for item in page.get("Items", []):
+            versions[item["hour"]["S"]] = int(item.get("version", {}).get("N", "0"))
+    return versions
+
+def decode_columnar_segment(body):
+    """Decodes a columnar raw segment (.spc) written by processSensorData.
+       The columns are memoryviews over the decompressed block, so their values are never copied.
+       Returns a dict with smartpot_id, the first and last timestamp, the timestamps column
+       (seconds since the epoch of the local measure_date) and one column per metric."""
+
+    magic, id_length, rows, first_timestamp, last_timestamp = SEGMENT_HEADER.unpack_from(body)
+    if magic != SEGMENT_MAGIC:
+        raise ValueError("Invalid columnar raw segment")
+
+    offset = SEGMENT_HEADER.size
+    smartpot_id = bytes(body[offset:offset + id_length]).decode("utf-8")
+    block = memoryview(zlib.decompress(memoryview(body)[offset + id_length:]))
+    column_size = rows * 8
+
+    columns = []
+    for index, typecode in enumerate(["q"] + ["d"] * len(METRICS)):
+        column = block[index * column_size:(index + 1) * column_size]
+        if sys.byteorder != "little":
+            column = array(typecode, column.tobytes())
+            column.byteswap()
+            columns.append(column)
+        else:
+            columns.append(column.cast(typecode))
 
-    event_file_path = f"events/daily_events_{smartpot_id}.json"
+    segment = {
+        "smartpot_id": smartpot_id,
+        "first_timestamp": first_timestamp,
+        "last_timestamp": last_timestamp,
+        "timestamps": columns[0]
+    }
+    segment.update(zip(METRICS, columns[1:]))
+    return segment
+
+def load_raw_records(file_key, body):
+    """Parses a raw data object downloaded from S3.
+       Supports both JSON Lines segments (.jsonl, one reading per line)
+       and legacy daily files (.json, a single array of readings)."""
+
+    if file_key.endswith(".jsonl"):
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+    return json.loads(body)
+
+def load_raw_segment(file_key, body):
+    """Loads a raw data object downloaded from S3 in columnar form.
+       Columnar segments (.spc) are decoded without copying; JSON objects (.jsonl segments and
+       legacy .json files) are converted to columns sorted by timestamp, with 'ERR' values as NaN."""
+
+    if file_key.endswith(".spc"):
+        return decode_columnar_segment(body)
+
+    rows = []
+    for record in load_raw_records(file_key, body.decode("utf-8")):
+        if "measure_date" not in record:
+            continue
+        timestamp = int((datetime.strptime(record["measure_date"], "%Y-%m-%d %H:%M:%S") - EPOCH).total_seconds())
+        values = [float(record[metric]) if record.get(metric, "ERR") != "ERR" else float("nan") for metric in METRICS]
+        rows.append([timestamp] + values)
+    rows.sort()
+
+    segment = {"timestamps": [row[0] for row in rows]}
+    for index, metric in enumerate(METRICS, start=1):
+        segment[metric] = [row[index] for row in rows]
+    return segment
+
+def merge_aggregates(aggregates, other):
+    """Merges {metric: [count, sum]} aggregates into aggregates."""
+
+    for metric in METRICS:
+        aggregates[metric][0] += other[metric][0]
+        aggregates[metric][1] += other[metric][1]
+
+def floor_hour(moment):
+    """Truncates a datetime to the start of its hour."""
+
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+def ceil_hour(moment):
+    """Rounds a datetime up to the start of the next hour, unless it is already hour-aligned."""
+
+    return moment if moment == floor_hour(moment) else floor_hour(moment) + timedelta(hours=1)
+
+def get_raw_partition(smartpot_id, hour):
+    """Retrieves the raw segments stored in S3 for a SmartPot in one hourly partition
+       (raw/<date>/<HH>/<smartpot_id>/), in columnar form."""
+
+    prefix = f"{RAW_FOLDER}{hour.strftime('%Y-%m-%d/%H')}/{smartpot_id}/"
+    file_keys = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        file_keys.extend(content["Key"] for content in page.get("Contents", [])
+                         if content["Key"].endswith((".jsonl", ".spc")))
+
+    # Un segmento per batch Kinesis: i download avvengono in parallelo
+    return list(segment_executor.map(download_raw_segment, file_keys))
+
+def download_raw_segment(file_key):
+    """Downloads a raw segment from S3 and loads it in columnar form."""
+
+    file_obj = s3.get_object(Bucket=S3_BUCKET, Key=file_key)
+    return load_raw_segment(file_key, file_obj["Body"].read())
+
+def get_legacy_raw_day(smartpot_id, day):
+    """Retrieves the raw data of a SmartPot stored for a whole day before the hourly partitions existed
+       (raw/<date>/<smartpot_id>.json and raw/<date>/<smartpot_id>/<sequence>.jsonl|.spc), in columnar form."""
+
+    day_file = f"{RAW_FOLDER}{day}/{smartpot_id}.json"
+    segments_prefix = f"{RAW_FOLDER}{day}/{smartpot_id}/"
+    file_keys = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=f"{RAW_FOLDER}{day}/{smartpot_id}"):
+        file_keys.extend(content["Key"] for content in page.get("Contents", [])
+                         if content["Key"] == day_file
+                         or (content["Key"].startswith(segments_prefix) and content["Key"].endswith((".jsonl", ".spc"))))
+    return list(segment_executor.map(download_raw_segment, file_keys))
+
+def aggregate_raw_data(smartpot_id, hour, start_time, end_time, has_rollup, legacy_days):
+    """Aggregates the raw readings of a SmartPot with start_time <= measure_date < end_time, all within hour.
+       The readings come from the hourly partition of the hour; an hour with neither a rollup nor a partition
+       predates them, so its readings are read from the legacy day data (downloaded once per day into legacy_days).
+       Each segment is sorted by timestamp, so the window is located with a binary search.
+       Returns {metric: [count, sum]}, ignoring 'ERR' values."""
+
+    aggregates = {metric: [0, 0.0] for metric in METRICS}
+    start_timestamp = (start_time - EPOCH).total_seconds()
+    end_timestamp = (end_time - EPOCH).total_seconds()
+
+    segments = get_raw_partition(smartpot_id, hour)
+    if not segments and not has_rollup:
+        day = hour.strftime("%Y-%m-%d")
+        if day not in legacy_days:
+            legacy_days[day] = get_legacy_raw_day(smartpot_id, day)
+        segments = legacy_days[day]
+
+    for segment in segments:
+        first = bisect_left(segment["timestamps"], start_timestamp)
+        last = bisect_left(segment["timestamps"], end_timestamp)
+
+        # Aggiungere i dati validi (NaN per i valori 'ERR')
+        for metric in METRICS:
+            values = [value for value in segment[metric][first:last] if value == value]
+            aggregates[metric][0] += len(values)
+            aggregates[metric][1] += sum(values)
+
+    return aggregates
+
+def compute_window_data(smartpot_id, start_time, end_time):
+    """Computes the mergeable data of a SmartPot for the interval [start_time, end_time).
+    A single rollups query covers every hour touched by the interval: the whole hours supply
+    the sensor aggregates, while the partial hours at its edges are read from their raw partitions in S3,
+    as are the hours without a rollup (falling back to the legacy day files for data stored before the migration).
+    Event counters have hourly resolution, so every hour starting before end_time is counted
+    (split points inside a report window are always hour-aligned, so no hour is counted twice).
+    Returns {"aggregates": {metric: [count, sum]}, "events": {event field: count}, "versions": {hour: version}},
+    with the version of every rollup item that was read."""
+
+    aggregates = {metric: [0, 0.0] for metric in METRICS}
+    events = {field: 0 for field in EVENT_FIELDS.values()}
+    versions = {}
+    if start_time >= end_time:
+        return {"aggregates": aggregates, "events": events, "versions": versions}
+
+    full_start = ceil_hour(start_time)
+    full_end = floor_hour(end_time)
+
+    for hour, item in get_rollups(smartpot_id, floor_hour(start_time), ceil_hour(end_time)):
+        versions[item["hour"]["S"]] = int(item.get("version", {}).get("N", "0"))
+        if full_start <= hour < full_end:
+            for metric in METRICS:
+                if metric in item:
+                    aggregates[metric][0] += int(item[metric]["M"]["count"]["N"])
+                    aggregates[metric][1] += float(item[metric]["M"]["sum"]["N"])
+        for event_type, field in EVENT_FIELDS.items():
+            if f"event_{event_type}" in item:
+                events[field] += int(item[f"event_{event_type}"]["N"])
+
+    legacy_days = {}
+    hour = floor_hour(start_time)
+    while hour < end_time:
+        has_rollup = hour.strftime("%Y-%m-%d %H") in versions
+        if not (has_rollup and full_start <= hour < full_end):
+            window_start, window_end = max(start_time, hour), min(end_time, hour + timedelta(hours=1))
+            merge_aggregates(aggregates, aggregate_raw_data(smartpot_id, hour, window_start, window_end, has_rollup, legacy_days))
+        hour += timedelta(hours=1)
+
+    return {"aggregates": aggregates, "events": events, "versions": versions}
+
+def merge_window_data(window_data, other):
+    """Merges the aggregates, event counts and rollup versions of other into window_data."""
+
+    merge_aggregates(window_data["aggregates"], other["aggregates"])
+    for event_type, count in other["events"].items():
+        window_data["events"][event_type] = window_data["events"].get(event_type, 0) + count
+    window_data.setdefault("versions", {}).update(other.get("versions", {}))
+
+def is_cached_window_current(smartpot_id, start_time, entry):
+    """True if no rollup of the hours covered by a cached window changed since it was cached.
+       Late data (Kinesis retries, iterator lag, replays of the bridge spool) bumps the version of its hourly
+       rollup, or creates it, so the versions read now must match the ones recorded in the entry."""
+
+    covered_until = datetime.fromisoformat(entry["covered_until"])
+    if covered_until <= start_time:
+        return True
+    return get_rollup_versions(smartpot_id, floor_hour(start_time), ceil_hour(covered_until)) == entry.get("versions", {})
+
+def get_cached_window(cache_key):
+    """Returns a cached report window, from the warm container or else from its S3 index entry."""
+
+    with report_cache_lock:
+        if cache_key in report_cache:
+            report_cache.move_to_end(cache_key)
+            return json.loads(json.dumps(report_cache[cache_key]))
 
     try:
-        obj = s3.get_object(Bucket=S3_BUCKET, Key=event_file_path)
-        events = json.loads(obj["Body"].read().decode("utf-8"))
+        obj = s3.get_object(Bucket=S3_BUCKET, Key=cache_key)
+        entry = json.loads(obj["Body"].read().decode("utf-8"))
     except s3.exceptions.NoSuchKey:
-        return {
-            "sensor_errors": 0,
-            "temperature_high": 0,
-            "temperature_low": 0,
-            "humidity_high": 0,
-            "humidity_low": 0,
-            "soil_moisture_high": 0,
-            "irrigation_completed": 0,
-            "irrigation_error": 0
-        }
+        return None
 
-    # Filtra eventi nell'intervallo di tempo specificato
-    event_counts = {
-        "sensor_errors": 0,
-        "temperature_high": 0,
-        "temperature_low": 0,
-        "humidity_high": 0,
-        "humidity_low": 0,
-        "soil_moisture_high": 0,
-        "irrigation_completed": 0,
-        "irrigation_error": 0
-    }
+    with report_cache_lock:
+        report_cache[cache_key] = entry
+        while len(report_cache) > REPORT_CACHE_SIZE:
+            report_cache.popitem(last=False)
+    return json.loads(json.dumps(entry))
 
-    for event in events:
-        event_time = datetime.strptime(event["timestamp"], "%Y-%m-%d %H:%M:%S")
-        if start_time <= event_time < end_time:
-            event_type = event["event_type"]
-            if event_type in event_counts:
-                event_counts[event_type] += 1
+def store_cached_window(cache_key, entry):
+    """Stores a report window in the warm-container LRU cache (evicting the least recently used)
+       and in its S3 index entry."""
 
-    return event_counts
+    with report_cache_lock:
+        report_cache[cache_key] = json.loads(json.dumps(entry))
+        report_cache.move_to_end(cache_key)
+        while len(report_cache) > REPORT_CACHE_SIZE:
+            report_cache.popitem(last=False)
 
-def generate_manual_report(smartpot_id, start_hour, end_hour):
-    """Generates a manual report for a given SmartPot and time interval.
-    Extracts raw temperature, humidity, and soil moisture values from S3.
+    try:
+        s3.put_object(Bucket=S3_BUCKET, Key=cache_key, Body=json.dumps(entry))
+    except Exception as e:
+        print(f"Error saving report cache entry {cache_key}: {e}")
+
+def get_window_data(smartpot_id, start_time, end_time):
+    """Returns the mergeable data of a SmartPot for [start_time, end_time), using the report cache.
+       Cache entries are keyed by (smartpot_id, start, end, REPORT_CACHE_VERSION) and cover the part of the
+       window that is already closed (older than the last full hour before now - REPORT_CACHE_GRACE),
+       recording the version of every rollup they were computed from (the data version).
+       An entry is reused only while those versions are unchanged, which costs one keys-only rollups query;
+       otherwise the closed part is recomputed. Only the part after the cached coverage is always recomputed."""
+
+    cache_key = (f"{REPORT_CACHE_FOLDER}v{REPORT_CACHE_VERSION}/{smartpot_id}/"
+                 f"{start_time.strftime('%Y%m%dT%H%M%S')}_{end_time.strftime('%Y%m%dT%H%M%S')}.json")
+    closed_until = floor_hour(datetime.now() - timedelta(seconds=REPORT_CACHE_GRACE))
+    closed_until = max(start_time, min(end_time, closed_until))
+
+    entry = get_cached_window(cache_key)
+    if entry is not None and not is_cached_window_current(smartpot_id, start_time, entry):
+        entry = None  # Dati arrivati in ritardo: la parte chiusa va ricalcolata
+    entry = entry or {
+        "covered_until": start_time.isoformat(),
+        "aggregates": {metric: [0, 0.0] for metric in METRICS},
+        "events": {},
+        "versions": {}
+    }
+    covered_until = datetime.fromisoformat(entry["covered_until"])
+
+    # Estende la parte chiusa in cache con i soli dati nuovi
+    if covered_until < closed_until:
+        merge_window_data(entry, compute_window_data(smartpot_id, covered_until, closed_until))
+        entry["covered_until"] = closed_until.isoformat()
+        store_cached_window(cache_key, entry)
+        covered_until = closed_until
+
+    # La parte ancora aperta della finestra viene sempre ricalcolata
+    window_data = {"aggregates": entry["aggregates"], "events": entry["events"]}
+    merge_window_data(window_data, compute_window_data(smartpot_id, covered_until, end_time))
+    return window_data
+
+def generate_manual_report(smartpot_id, start_time, end_time):
+    """Generates a manual report for a given SmartPot and time interval [start_time, end_time).
+    Retrieves the interval's aggregates and events through the report cache.
     Computes averages and aggregates event data.
     Returns the final report data."""
 
-    current_date = datetime.now().strftime("%Y-%m-%d")
-    previous_date = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    window_data = get_window_data(smartpot_id, start_time, end_time)
+    aggregates = window_data["aggregates"]
 
-    # Determinare se il range attraversa la mezzanotte
-    if start_hour > end_hour:
-        dates_to_check = [previous_date, current_date]  # Controlla ieri e oggi
-    else:
-        dates_to_check = [current_date]  # Controlla solo oggi
+    if not any(count for count, _ in aggregates.values()):
+        return None
 
-    start_time = datetime.strptime(f"{current_date} {start_hour}:00:00", "%Y-%m-%d %H:%M:%S")
-    end_time = datetime.strptime(f"{current_date} {end_hour}:00:00", "%Y-%m-%d %H:%M:%S")
+    # Date coperte dall'intervallo
+    dates = []
+    day = start_time.date()
+    while day <= (end_time - timedelta(microseconds=1)).date():
+        dates.append(day.strftime("%Y-%m-%d"))
+        day += timedelta(days=1)
 
-    report_data = {
+    # Calculate averages
+    report = {
         "smartpot_id": smartpot_id,
-        "date_range": dates_to_check,
-        "time_range": f"{start_hour}:00 - {end_hour}:00",
-        "temperature": [],
-        "humidity": [],
-        "soil_moisture": []
+        "date_range": dates,
+        "time_range": f"{start_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')}",
+        "avg_temperature": calculate_average(aggregates["temperature"]),
+        "avg_humidity": calculate_average(aggregates["humidity"]),
+        "avg_soil_moisture": calculate_average(aggregates["soil_moisture"])
     }
 
-    data_found = False
-
-    for date in dates_to_check:
-        file_key = f"{RAW_FOLDER}{date}/{smartpot_id}.json"
+    # Include event data
+    report.update(window_data["events"])
 
-        try:
-            file_obj = s3.get_object(Bucket=S3_BUCKET, Key=file_key)
-            data = json.loads(file_obj["Body"].read().decode("utf-8"))
-
-            for record in data:
-                if record.get("smartpot_id") != smartpot_id:
-                    continue
-
-                if "measure_date" not in record:
-                    continue
-
-                record_time = datetime.strptime(record["measure_date"], "%Y-%m-%d %H:%M:%S")
-
-                if start_time <= record_time < end_time:
-                    data_found = True
+    return report
 
-                # Aggiungere i dati validi
-                if "temperature" in record and record["temperature"] != "ERR":
-                    report_data["temperature"].append(float(record["temperature"]))
-                if "humidity" in record and record["humidity"] != "ERR":
-                    report_data["humidity"].append(float(record["humidity"]))
-                if "soil_moisture" in record and record["soil_moisture"] != "ERR":
-                    report_data["soil_moisture"].append(float(record["soil_moisture"]))
+def get_requested_window(body):
+    """Reads the time window of a manual report request.
+       Accepts full datetimes in "start" and "end" (ISO 8601, e.g. "2025-03-01 08:30"), spanning any number of days,
+       or the legacy "start_hour" and "end_hour" of the current day (a start hour after the end hour starts the day before).
+       Returns (start_time, end_time, label), where label is used in the report file name."""
 
-        except s3.exceptions.NoSuchKey:
-            print(f"No data found for {smartpot_id} on {date}")
+    if body.get("start") and body.get("end"):
+        start_time = datetime.fromisoformat(body["start"])
+        end_time = datetime.fromisoformat(body["end"])
+        label = f"{start_time.strftime('%Y%m%dT%H%M')}-{end_time.strftime('%Y%m%dT%H%M')}"
+        return start_time, end_time, label
 
-    if not data_found:
-        return None
+    start_hour = int(body.get("start_hour"))
+    end_hour = int(body.get("end_hour"))
+    current_date = floor_hour(datetime.now()).replace(hour=0)
 
-    # Calculate averages
-    report = {
-        "smartpot_id": smartpot_id,
-        "date_range": dates_to_check,
-        "time_range": f"{start_hour}:00 - {end_hour}:00",
-        "avg_temperature": calculate_average(report_data["temperature"]),
-        "avg_humidity": calculate_average(report_data["humidity"]),
-        "avg_soil_moisture": calculate_average(report_data["soil_moisture"])
-    }
+    # Determinare se il range attraversa la mezzanotte
+    start_date = current_date - timedelta(days=1) if start_hour > end_hour else current_date
+    start_time = start_date.replace(hour=start_hour)
+    end_time = current_date.replace(hour=end_hour)
+    label = f"{start_hour}-{end_hour}_{datetime.now().strftime('%Y-%m-%d')}"
+    return start_time, end_time, label
 
-    # Retrieve and include event data
-    event_data = get_event_data(smartpot_id, start_time, end_time)
-    report.update(event_data)
+def register_report(report_key, body):
+    """Registers a stored report in the reports catalog, so getReport can find it with a single point read."""
 
-    return report
+    try:
+        dynamodb.put_item(
+            TableName=DYNAMODB_REPORTS_TABLE,
+            Item={
+                "report_name": {"S": report_key.rsplit("/", 1)[-1]},
+                "report_key": {"S": report_key},
+                "report_type": {"S": REPORT_TYPE},
+                "size": {"N": str(len(body.encode("utf-8")))},
+                "created_at": {"S": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+            }
+        )
+    except Exception as e:
+        print(f"Error registering report {report_key} in the catalog: {e}")
 
 def lambda_handler(event, context):
     """AWS Lambda handler function to create the manual report."""
@@ -157,29 +486,35 @@ def lambda_handler(event, context):
     try:
         body = json.loads(event["body"])
         smartpot_id = body.get("smartpot_id", "").strip()
-        start_hour = int(body.get("start_hour"))
-        end_hour = int(body.get("end_hour"))
+        start_time, end_time, label = get_requested_window(body)
 
-        if start_hour == end_hour:
+        if start_time == end_time:
             return {
                 "statusCode": 400,
                 "body": json.dumps({"error": "Start hour and end hour cannot be the same."})
             }
 
+        if start_time > end_time:
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": "Start must be before end."})
+            }
+
         reports = []
 
         if smartpot_id and smartpot_id != "All":
-            report = generate_manual_report(smartpot_id, start_hour, end_hour)
+            report = generate_manual_report(smartpot_id, start_time, end_time)
             if report:
                 reports.append(report)
-                report_filename = f"{REPORT_FOLDER}manual_report_{smartpot_id}_{start_hour}-{end_hour}_{datetime.now().strftime('%Y-%m-%d')}.json"
+                report_filename = f"{REPORT_FOLDER}manual_report_{smartpot_id}_{label}.json"
         else:
-            for smartpot in ["Strawberry", "Basil"]:
-                report = generate_manual_report(smartpot, start_hour, end_hour)
-                if report:
-                    reports.append(report)
+            # Report di tutti i vasi registrati, generati in parallelo
+            with ThreadPoolExecutor(max_workers=REPORT_WORKERS) as executor:
+                all_reports = executor.map(lambda smartpot: generate_manual_report(smartpot, start_time, end_time),
+                                           get_smartpot_ids())
+                reports.extend(report for report in all_reports if report)
 
-            report_filename = f"{REPORT_FOLDER}manual_report_All_{start_hour}-{end_hour}_{datetime.now().strftime('%Y-%m-%d')}.json"
+            report_filename = f"{REPORT_FOLDER}manual_report_All_{label}.json"
 
         if not reports:
             return {
@@ -188,7 +523,9 @@ def lambda_handler(event, context):
             }
 
         # Save report to S3
-        s3.put_object(Bucket=S3_BUCKET, Key=report_filename, Body=json.dumps(reports, indent=4))
+        report_body = json.dumps(reports, indent=4)
+        s3.put_object(Bucket=S3_BUCKET, Key=report_filename, Body=report_body)
+        register_report(report_filename, report_body)
 
         return {
             "statusCode": 200,
@@ -1,83 +1,157 @@
 import os
 import json
 import time
+import base64
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 import boto3
+from botocore.config import Config
 
 # Load environment variables
 LOCALSTACK_HOSTNAME = os.getenv("LOCALSTACK_HOSTNAME", "localhost")
 EDGE_PORT = os.getenv("EDGE_PORT", "4566")
 AWS_REGION = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
 
+# Number of report contents downloaded concurrently within a page
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "10"))
+
 # AWS Clients
 ENDPOINT_URL = f"http://{LOCALSTACK_HOSTNAME}:{EDGE_PORT}"
-s3 = boto3.client("s3", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
+s3 = boto3.client("s3", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION,
+                  config=Config(max_pool_connections=FETCH_WORKERS))
 
 # Configurations
 S3_BUCKET = os.getenv("S3_BUCKET", "smartpotsystem-s3-bucket")
 MANUAL_REPORTS_FOLDER = "reports/manual/"
 DAILY_REPORTS_FOLDER = "reports/daily/"
+REPORT_FOLDERS = [("manual", MANUAL_REPORTS_FOLDER), ("daily", DAILY_REPORTS_FOLDER)]
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 1000
 
-def get_all_reports_keys():
-    """Retrieves a list of all report files (both daily and manual) stored in S3.
-       Searches under:reports/manual/ (for manual reports) and reports/daily/ (for daily reports)
-       Returns a list of report file names."""
-    
-    reports = []
-    for folder in [MANUAL_REPORTS_FOLDER, DAILY_REPORTS_FOLDER]:
-        response = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=folder)
-        if "Contents" in response:
-            reports.extend([content["Key"] for content in response["Contents"] if "Key" in content])
-    return reports if reports else None
-
-def get_all_reports(only_names=False):
-    """Fetches all stored reports from S3.
+def encode_cursor(folder_index, last_key):
+    """Encodes the position reached in the report listing as an opaque cursor."""
+    return base64.urlsafe_b64encode(json.dumps({"folder": folder_index, "after": last_key}).encode("utf-8")).decode("utf-8")
+
+def decode_cursor(cursor):
+    """Decodes a cursor returned by a previous page. Returns (folder_index, last_key)."""
+    if not cursor:
+        return 0, None
+    position = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8"))
+    return int(position["folder"]), position["after"]
+
+def list_reports_page(limit, cursor=None, report_type=None, date_from=None, date_to=None):
+    """Lists up to `limit` report files (manual reports first, then daily reports), starting after `cursor`.
+       Only lists the folder of `report_type` if given, and keeps the reports last modified
+       between `date_from` and `date_to` (inclusive dates) if given.
+       Returns (entries, next_cursor), where each entry is (key, type) and next_cursor is None on the last page."""
+
+    start_folder, last_key = decode_cursor(cursor)
+    entries = []
+
+    for folder_index, (folder_type, folder) in enumerate(REPORT_FOLDERS):
+        if folder_index < start_folder or report_type not in (None, folder_type):
+            continue
+
+        start_after = last_key if folder_index == start_folder else None
+        while True:
+            request = {"Bucket": S3_BUCKET, "Prefix": folder}
+            if start_after:
+                request["StartAfter"] = start_after
+            response = s3.list_objects_v2(**request)
+
+            for content in response.get("Contents", []):
+                start_after = content["Key"]
+                modified = content["LastModified"].date()
+                if (date_from and modified < date_from) or (date_to and modified > date_to):
+                    continue
+
+                entries.append((content["Key"], folder_type))
+                if len(entries) == limit:
+                    return entries, encode_cursor(folder_index, content["Key"])
+
+            if not response.get("IsTruncated"):
+                break
+
+    return entries, None
+
+def get_report_content(key):
+    """Downloads the content of a report from S3."""
+    response = s3.get_object(Bucket=S3_BUCKET, Key=key)
+    return response["Body"].read().decode("utf-8")
+
+def get_all_reports(only_names=False, limit=DEFAULT_PAGE_SIZE, cursor=None, report_type=None, date_from=None, date_to=None):
+    """Fetches one page of stored reports from S3.
        If only_names=True, returns only the file names.
-       If only_names=False, retrieves the full content of each report.
+       If only_names=False, retrieves the full content of each report of the page concurrently.
        Formats the output to include: Report name (without folder prefix).Report type (manual or daily).
-       Full content (if requested)."""
-
-    keys = get_all_reports_keys()
-    if keys is not None:
-        reports = []
-        for key in keys:
-            report_entry = {
-                "key": key.replace(MANUAL_REPORTS_FOLDER, "").replace(DAILY_REPORTS_FOLDER, ""),  # Remove folder prefix
-                "type": "manual" if MANUAL_REPORTS_FOLDER in key else "daily"
-            }
-            if not only_names:
-                response = s3.get_object(Bucket=S3_BUCKET, Key=key)
-                report_entry["bytes"] = response["Body"].read().decode("utf-8")
-            
-            reports.append(report_entry)
-        
-        return reports
-    return None
+       Full content (if requested).
+       Returns (reports, next_cursor)."""
+
+    entries, next_cursor = list_reports_page(limit, cursor, report_type, date_from, date_to)
+
+    reports = [{
+        "key": key.replace(MANUAL_REPORTS_FOLDER, "").replace(DAILY_REPORTS_FOLDER, ""),  # Remove folder prefix
+        "type": folder_type
+    } for key, folder_type in entries]
+
+    if not only_names:
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            for report_entry, content in zip(reports, executor.map(get_report_content, [key for key, _ in entries])):
+                report_entry["bytes"] = content
+
+    return reports, next_cursor
+
+def build_response(status_code, payload, compress=False):
+    """Builds the API Gateway response. With compress the body is the gzip of the JSON payload, returned
+       as application/gzip: API Gateway only delivers it as binary because the REST API lists that type
+       in its binaryMediaTypes (see install.sh) and the client accepts it."""
+
+    body = json.dumps(payload)
+    if not compress:
+        return {"statusCode": status_code, "headers": {"Content-Type": "application/json"}, "body": body}
+
+    return {
+        "statusCode": status_code,
+        "headers": {"Content-Type": "application/gzip"},
+        "isBase64Encoded": True,
+        "body": base64.b64encode(gzip.compress(body.encode("utf-8"))).decode("utf-8")
+    }
 
 def lambda_handler(event, context):
-    """AWS Lambda entry point for retrieving all stored reports."""
+    """AWS Lambda entry point for retrieving a page of stored reports.
+       Query parameters: onlyNames, limit, cursor (nextCursor of the previous page),
+       type (daily or manual), from and to (YYYY-MM-DD), compress.
+       Payloads are gzip-compressed only when compress=true (opt-in, see build_response)."""
     
     os.putenv("TZ", "Europe/Rome")
     time.tzset()
     
     try:
         # Controlla se la richiesta include il parametro `onlyNames`
-        query_params = event.get("queryStringParameters", {})
+        query_params = event.get("queryStringParameters") or {}
         only_names = query_params.get("onlyNames", "false").lower() == "true"
+        limit = min(max(int(query_params.get("limit", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        cursor = query_params.get("cursor")
+        report_type = query_params.get("type")
+        date_from = date.fromisoformat(query_params["from"]) if query_params.get("from") else None
+        date_to = date.fromisoformat(query_params["to"]) if query_params.get("to") else None
+
+        compress = query_params.get("compress", "false").lower() == "true"
 
-        reports = get_all_reports(only_names=only_names)
+        if report_type not in (None, "daily", "manual"):
+            return build_response(400, {"message": "type must be daily or manual"})
 
-        if reports is not None:
-            return {
-                "statusCode": 200,
-                "headers": {"Content-Type": "application/json"},
-                "body": json.dumps(reports)
-            }
+        reports, next_cursor = get_all_reports(only_names, limit, cursor, report_type, date_from, date_to)
+
+        if reports or cursor:
+            return build_response(200, {"reports": reports, "nextCursor": next_cursor}, compress)
         else:
-            return {
-                "statusCode": 404,
-                "headers": {"Content-Type": "application/json"},
-                "body": json.dumps({"message": "No reports found"})
-            }
+            return build_response(404, {"message": "No reports found"})
+
+    except (ValueError, KeyError) as e:
+        print(f"Invalid request parameters: {e}")
+        return build_response(400, {"message": "Invalid request parameters"})
 
     except Exception as e:
         print(f"Error retrieving reports: {e}")
@@ -1,47 +1,117 @@
 import json
 import os
+import time
+import hashlib
 import boto3
+from collections import OrderedDict
 
 # Load environment variables
 LOCALSTACK_HOSTNAME = os.getenv("LOCALSTACK_HOSTNAME", "localhost")
 EDGE_PORT = os.getenv("EDGE_PORT", "4566")
 AWS_REGION = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
 DYNAMODB_TABLE = os.getenv("DYNAMODB_TABLE", "SmartPotData")
+LATEST_DATA_TTL = int(os.getenv("LATEST_DATA_TTL", "5"))  # Seconds a cached response is reused
+LATEST_DATA_CACHE_SIZE = int(os.getenv("LATEST_DATA_CACHE_SIZE", "64"))  # Distinct smartpot_id lists kept
+BATCH_GET_SIZE = 100  # Maximum number of keys accepted by batch_get_item
+PROJECTION = "smartpot_id, temperature, humidity, soil_moisture, last_irrigation, measure_date"
 
 # Initialize AWS Clients
 ENDPOINT_URL = f"http://{LOCALSTACK_HOSTNAME}:{EDGE_PORT}"
 dynamodb = boto3.client("dynamodb", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
 
-def get_latest_data():
-    """Fetches the latest data from DynamoDB for each pot and returns structured JSON."""
+# Warm-container LRU cache: requested smartpot_ids -> (cached_at, pots_data, etag)
+latest_data_cache = OrderedDict()
+
+def format_item(item):
+    """Formats a DynamoDB item of the latest-value table for the API response."""
+
+    return {
+        "smartpot_id": item["smartpot_id"]["S"], 
+        "temperature": item.get("temperature", {}).get("S", "N/A"),
+        "humidity": item.get("humidity", {}).get("S", "N/A"),
+        "soil_moisture": item.get("soil_moisture", {}).get("S", "N/A"),
+        "last_irrigation": item.get("last_irrigation", {}).get("S", "N/A"),
+        "measure_date": item.get("measure_date", {}).get("S", "N/A")
+    }
+
+def read_latest_data(smartpot_ids):
+    """Reads the latest data from DynamoDB, projecting only the returned attributes.
+       Specific SmartPots are fetched with point reads (batch_get_item);
+       otherwise the whole table is scanned, following pagination."""
+
+    items = []
+    if smartpot_ids:
+        for start in range(0, len(smartpot_ids), BATCH_GET_SIZE):
+            request = {DYNAMODB_TABLE: {
+                "Keys": [{"smartpot_id": {"S": smartpot_id}} for smartpot_id in smartpot_ids[start:start + BATCH_GET_SIZE]],
+                "ProjectionExpression": PROJECTION
+            }}
+            while request:
+                response = dynamodb.batch_get_item(RequestItems=request)
+                items.extend(response.get("Responses", {}).get(DYNAMODB_TABLE, []))
+                request = response.get("UnprocessedKeys")
+    else:
+        paginator = dynamodb.get_paginator("scan")
+        for page in paginator.paginate(TableName=DYNAMODB_TABLE, ProjectionExpression=PROJECTION):
+            items.extend(page.get("Items", []))
+
+    return sorted((format_item(item) for item in items), key=lambda pot: pot["smartpot_id"])
+
+def compute_etag(pots_data):
+    """Derives the ETag of a response from the measure_date and last_irrigation of every pot,
+       so an update to any pot changes it (also when it is older than the newest one of the response)."""
+
+    versions = "\n".join(f"{pot['smartpot_id']}|{pot['measure_date']}|{pot['last_irrigation']}" for pot in pots_data)
+    return '"' + hashlib.sha1(versions.encode("utf-8")).hexdigest() + '"'
+
+def cache_latest_data(cache_key, pots_data, etag):
+    """Caches a response, dropping the expired entries and then the least recently used ones
+       beyond LATEST_DATA_CACHE_SIZE (the keys come from client-supplied smartpot_id lists)."""
+
+    now = time.time()
+    for key in [key for key, (cached_at, _, _) in latest_data_cache.items() if now - cached_at >= LATEST_DATA_TTL]:
+        del latest_data_cache[key]
+
+    latest_data_cache[cache_key] = (now, pots_data, etag)
+    latest_data_cache.move_to_end(cache_key)
+    while len(latest_data_cache) > LATEST_DATA_CACHE_SIZE:
+        latest_data_cache.popitem(last=False)
+
+def get_latest_data(smartpot_ids=None, if_none_match=None):
+    """Fetches the latest data from DynamoDB for each pot and returns structured JSON.
+       Responses are cached in the warm container for LATEST_DATA_TTL seconds.
+       Returns 304 Not Modified when if_none_match matches the current ETag."""
 
     try:
-        # Scan the table for all available records
-        response = dynamodb.scan(TableName=DYNAMODB_TABLE)
+        cache_key = tuple(smartpot_ids or ())
+        cached = latest_data_cache.get(cache_key)
+
+        if cached and time.time() - cached[0] < LATEST_DATA_TTL:
+            _, pots_data, etag = cached
+            latest_data_cache.move_to_end(cache_key)
+        else:
+            pots_data = read_latest_data(list(cache_key))
+            etag = compute_etag(pots_data)
+            cache_latest_data(cache_key, pots_data, etag)
 
         # If no items are found, return a 404 response
-        if "Items" not in response or not response["Items"]:
+        if not pots_data:
             return {
                 "statusCode": 404,
                 "body": json.dumps({"error": "No data found in the table."})
             }
 
-        # Format the data into a structured list
-        pots_data = []
-        for item in response["Items"]:
-            pots_data.append({
-                "smartpot_id": item["smartpot_id"]["S"], 
-                "temperature": item["temperature"]["S"],
-                "humidity": item["humidity"]["S"],
-                "soil_moisture": item["soil_moisture"]["S"],
-                "last_irrigation": item.get("last_irrigation", {}).get("S", "N/A"),
-                "measure_date": item.get("measure_date", {}).get("S", "N/A")
-            })
+        headers = {"ETag": etag, "Cache-Control": f"max-age={LATEST_DATA_TTL}"}
+
+        # The client already has the latest version
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return {"statusCode": 304, "headers": headers, "body": ""}
 
         # Return structured data
+        headers["Content-Type"] = "application/json"
         return {
             "statusCode": 200,
-            "headers": {"Content-Type": "application/json"},
+            "headers": headers,
             "body": json.dumps({"latestData": pots_data})
         }
 
@@ -53,6 +123,11 @@ def get_latest_data():
         }
 
 def lambda_handler(event, context):
-    """Handles API Gateway request to fetch the latest pot data."""
+    """Handles API Gateway request to fetch the latest pot data.
+       The optional smartpot_id query parameter (comma-separated) limits the response to those pots."""
     
-    return get_latest_data()
+    query_params = event.get("queryStringParameters") or {}
+    headers = {key.lower(): value for key, value in (event.get("headers") or {}).items()}
+
+    smartpot_ids = sorted({pot.strip() for pot in query_params.get("smartpot_id", "").split(",") if pot.strip()})
+    return get_latest_data(smartpot_ids, headers.get("if-none-match"))
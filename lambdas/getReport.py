@@ -8,27 +8,45 @@ LOCALSTACK_HOSTNAME = os.getenv("LOCALSTACK_HOSTNAME", "localhost")
 EDGE_PORT = os.getenv("EDGE_PORT", "4566")
 AWS_REGION = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET", "smartpotsystem-s3-bucket")
+DYNAMODB_REPORTS_TABLE = os.getenv("DYNAMODB_REPORTS_TABLE", "SmartPotReports")
 
 # Initialize AWS Clients
 ENDPOINT_URL = f"http://{LOCALSTACK_HOSTNAME}:{EDGE_PORT}"
 s3 = boto3.client("s3", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
+dynamodb = boto3.client("dynamodb", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
+
+def get_report_key(name: str):
+    """Looks up the S3 key of a report in the reports catalog (single point read).
+       Returns None if the report is not registered."""
+
+    try:
+        response = dynamodb.get_item(
+            TableName=DYNAMODB_REPORTS_TABLE,
+            Key={"report_name": {"S": name}},
+            ProjectionExpression="report_key"
+        )
+        return response.get("Item", {}).get("report_key", {}).get("S")
+    except Exception as e:
+        print(f"Error reading the reports catalog: {e}")
+        return None
 
 def get_file_from_name(name: str):
-    """Check if a specific file exists and retrieve it, first from 'daily/' then from 'manual/'."""
+    """Retrieve a specific report by name.
+       The S3 key comes from the reports catalog; reports stored before the catalog
+       existed are read directly from 'daily/' and then 'manual/'."""
     
-    for folder in ["reports/daily/", "reports/manual/"]:
-        response = s3.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=folder)
-        if 'Contents' in response:
-            for content in response['Contents']:
-                if content["Key"].endswith(name):
-                    try:
-                        response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=content["Key"])
-                        return {
-                            "key": content["Key"],
-                            "bytes": response['Body'].read().decode('utf-8')
-                        }
-                    except s3.exceptions.NoSuchKey:
-                        return None
+    report_key = get_report_key(name)
+    candidate_keys = [report_key] if report_key else [f"{folder}{name}" for folder in ["reports/daily/", "reports/manual/"]]
+
+    for key in candidate_keys:
+        try:
+            response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=key)
+            return {
+                "key": key,
+                "bytes": response['Body'].read().decode('utf-8')
+            }
+        except s3.exceptions.NoSuchKey:
+            continue
     return None
 
 def lambda_handler(event, context):
@@ -1,8 +1,12 @@
 import json
 import os
+import threading
 import time
 import boto3
 import urllib3
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Load environment variables
@@ -11,6 +15,26 @@ EDGE_PORT = os.getenv("EDGE_PORT", "4566")
 AWS_REGION = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
 SQS_QUEUE_NAME = os.getenv("SQS_QUEUE", "SmartPotAlertsQueue")
 S3_BUCKET = os.getenv("S3_BUCKET", "smartpotsystem-s3-bucket")
+DYNAMODB_TABLE = os.getenv("DYNAMODB_TABLE", "SmartPotData")
+DYNAMODB_ROLLUPS_TABLE = os.getenv("DYNAMODB_ROLLUPS_TABLE", "SmartPotRollups")
+EVENT_AUDIT_LOG = os.getenv("EVENT_AUDIT_LOG", "false").lower() == "true"
+EVENTS_FOLDER = "events/"
+UNCOUNTED_EVENTS = ["daily_report", "manual_report"]  # Notifications that are not SmartPot events
+
+# Alert digest: repeated alerts of the same SmartPot and issue within the window are merged into a summary
+ALERT_DIGEST_WINDOW = int(os.getenv("ALERT_DIGEST_WINDOW", "900"))  # Seconds
+CRITICAL_ALERTS = ["sensor_error", "irrigation_error", "daily_report", "manual_report"]  # Never suppressed
+
+# Number of Telegram notifications sent concurrently
+TELEGRAM_WORKERS = int(os.getenv("TELEGRAM_WORKERS", "4"))
+
+# Telegram rate limit (token bucket) and retries
+TELEGRAM_RATE = float(os.getenv("TELEGRAM_RATE", "1"))  # Messages per second
+TELEGRAM_BURST = int(os.getenv("TELEGRAM_BURST", "3"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+TELEGRAM_MAX_RETRY_AFTER = 30  # Longest wait (seconds) accepted from a 429 response before giving up
+TELEGRAM_REQUEST_TIMEOUT = 5  # Seconds
+LAMBDA_TIME_MARGIN = 3  # Seconds kept free before the Lambda timeout to store the events and answer SQS
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
@@ -20,56 +44,155 @@ TELEGRAM_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
 ENDPOINT_URL = f"http://{LOCALSTACK_HOSTNAME}:{EDGE_PORT}"
 sqs = boto3.client("sqs", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
 s3 = boto3.client("s3", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
+dynamodb = boto3.client("dynamodb", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
 
 queue_url = sqs.get_queue_url(QueueName=SQS_QUEUE_NAME)["QueueUrl"]
 
 # Initialize HTTP PoolManager for Telegram API
-http = urllib3.PoolManager()
+http = urllib3.PoolManager(maxsize=TELEGRAM_WORKERS)
+
+class TokenBucket:
+    """Thread-safe token bucket limiting the rate of Telegram API calls.
+       Holds up to capacity tokens, refilled at rate tokens per second; acquire() blocks until one is available
+       or gives up if it would only be available after the deadline.
+       pause() empties the bucket for the given time, when Telegram asks to slow down."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        """Takes a token, waiting for the refill if the bucket is empty.
+           Returns False without waiting if the token would arrive after deadline (time.monotonic())."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Empties the bucket so that no token is available for the given number of seconds."""
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+            self.updated = time.monotonic()
+
+# Shared by every sender thread of the warm container
+telegram_bucket = TokenBucket(TELEGRAM_RATE, TELEGRAM_BURST)
+
+def send_telegram_message(message_text, deadline=None):
+    """Sends a notification message to a Telegram chat using the Telegram Bot API.
+       Every attempt takes a token from telegram_bucket. Throttled requests (HTTP 429) are retried
+       after the retry_after requested by Telegram, other failures with an exponential backoff.
+       No wait or retry goes beyond deadline (time.monotonic()): the message is then left to SQS.
+       Returns True if Telegram accepted the message, None if it can never be sent (missing configuration,
+       or a 4xx other than 429, e.g. invalid token or chat), False if it should be retried later."""
+    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
+        print("Error sending Telegram notification: TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID not set")
+        return None
 
-def send_telegram_message(message_text):
-    """Sends a notification message to a Telegram chat using the Telegram Bot API."""
     payload = {
         "text": message_text,
         "chat_id": TELEGRAM_CHAT_ID
     }
-    try:
-        http.request('POST', TELEGRAM_URL, body=json.dumps(payload), headers={'Content-Type': 'application/json'})
-    except Exception as e:
-        print(f"Error sending Telegram notification: {e}")
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        if not telegram_bucket.acquire(deadline):
+            print("Error sending Telegram notification: no time left in this invocation")
+            return False
+        timeout = TELEGRAM_REQUEST_TIMEOUT
+        if deadline is not None:
+            timeout = max(0.5, min(timeout, deadline - time.monotonic()))
+        try:
+            response = http.request('POST', TELEGRAM_URL, body=json.dumps(payload),
+                                    headers={'Content-Type': 'application/json'}, timeout=timeout)
+            if response.status == 200:
+                return True
 
-def save_event(smartpot_id, alert_type):
-    """Saves an event in an S3 file.
-       Maintains a history of alerts in events/daily_events_<smartpot_id>.json.
-       Appends new events with a timestamp."""
+            if response.status == 429:
+                try:
+                    retry_after = json.loads(response.data.decode("utf-8"))["parameters"]["retry_after"]
+                except Exception:
+                    retry_after = 2 ** attempt
+                if retry_after > TELEGRAM_MAX_RETRY_AFTER:
+                    print(f"Error sending Telegram notification: throttled for {retry_after}s")
+                    return False
+                telegram_bucket.pause(retry_after)
+                continue
 
-    event_file_path = f"events/daily_events_{smartpot_id}.json"
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print(f"Error sending Telegram notification: HTTP {response.status}")
+            if response.status < 500:
+                return None  # Rifiutato da Telegram: riprovare non cambierebbe l'esito
+        except Exception as e:
+            print(f"Error sending Telegram notification: {e}")
 
-    try:
-        # Retrieve existing event file
-        obj = s3.get_object(Bucket=S3_BUCKET, Key=event_file_path)
-        events = json.loads(obj["Body"].read().decode("utf-8"))
-    except s3.exceptions.NoSuchKey:
-        events = []
+        if attempt < TELEGRAM_MAX_RETRIES:
+            if deadline is not None and time.monotonic() + 2 ** attempt > deadline:
+                return False
+            time.sleep(2 ** attempt)
+    return False
+
+def save_events(alerts):
+    """Counts a batch of events in the hourly rollups of their SmartPots.
+       Events are grouped per (smartpot_id, hour), so each group is stored with a single atomic ADD
+       of all its event_<alert_type> counters and concurrent invocations never lose events.
+       The ADD also bumps the rollup version, so cached manual report windows notice the new events.
+       If EVENT_AUDIT_LOG is enabled, every event is also appended to the audit log in S3
+       as a new object (events/<date>/<hour>/<smartpot_id>/<timestamp>-<id>.json).
+       Returns the message ids of the events that could not be stored."""
+
+    now = datetime.now()
+    hour = now.strftime("%Y-%m-%d %H")
+
+    # Raggruppa gli eventi per SmartPot
+    groups = {}
+    for message_id, alert_message in alerts:
+        groups.setdefault(alert_message.get("smartpot_id", "ALL"), []).append((message_id, alert_message.get("issue")))
+
+    failed = []
+    for smartpot_id, events in groups.items():
+        try:
+            counts = Counter(alert_type for _, alert_type in events
+                             if alert_type not in UNCOUNTED_EVENTS and not (alert_type or "").endswith("_resolved"))
+            if counts:
+                counters = list(counts.items())
+                dynamodb.update_item(
+                    TableName=DYNAMODB_ROLLUPS_TABLE,
+                    Key={"smartpot_id": {"S": smartpot_id}, "hour": {"S": hour}},
+                    UpdateExpression="ADD #version :one, " + ", ".join(f"#event{index} :count{index}" for index in range(len(counters))),
+                    ExpressionAttributeNames={"#version": "version",
+                                              **{f"#event{index}": f"event_{alert_type}" for index, (alert_type, _) in enumerate(counters)}},
+                    ExpressionAttributeValues={":one": {"N": "1"},
+                                               **{f":count{index}": {"N": str(count)} for index, (_, count) in enumerate(counters)}}
+                )
 
-    # Append new event
-    events.append({"timestamp": current_time, "event_type": alert_type})
+            if EVENT_AUDIT_LOG:
+                for _, alert_type in events:
+                    event_key = f"{EVENTS_FOLDER}{now.strftime('%Y-%m-%d/%H')}/{smartpot_id}/{now.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex}.json"
+                    s3.put_object(Bucket=S3_BUCKET, Key=event_key,
+                                  Body=json.dumps({"timestamp": now.strftime("%Y-%m-%d %H:%M:%S"), "event_type": alert_type}))
 
-    # Save updated events to S3
-    s3.put_object(Bucket=S3_BUCKET, Key=event_file_path, Body=json.dumps(events))
+        except Exception as e:
+            print(f"Error saving events for SmartPot {smartpot_id}: {e}")
+            failed.extend(message_id for message_id, _ in events)
 
-def process_alert(alert_message):
-    """Processes an incoming alert message from an SQS queue.
-       Sends the formatted message to Telegram.
-       Saves the alert event in S3 for tracking."""
+    return failed
+
+def format_alert(alert_message):
+    """Builds the Telegram text of an incoming alert message from an SQS queue."""
 
     smartpot_id = alert_message.get("smartpot_id", "ALL")
     alert_type = alert_message.get("issue")
     details = alert_message.get("details", {})
 
-    if not smartpot_id:
-        return
-
     # **Usa direttamente il messaggio fornito per `daily_report` e `manual_report`**
     if alert_type in ["daily_report", "manual_report"]:
         message = details.get("message", "ℹ️ Report notification received.")
@@ -100,38 +223,256 @@ def process_alert(alert_message):
         elif alert_type == 'irrigation_error':
             message = f"💧 Irrigation error for SmartPot {smartpot_id}."
 
+        elif alert_type and alert_type.endswith("_resolved"):
+            message = f"✅ {alert_type[:-len('_resolved')]} resolved for SmartPot {smartpot_id}."
+            if details:
+                message += f"\n📈 Current: {', '.join(f'{key} {value}' for key, value in details.items())}."
+
         elif alert_type == "soil_moisture_high":
             message = f"🌱 High soil moisture alert in SmartPot {smartpot_id}.\n💧 Moisture Level: {details.get('soil_moisture', 'N/A')}% (Above max limit)."
 
         else:
             message = f"ℹ️ Notification received for SmartPot {smartpot_id}: {alert_type}"
 
-    # **Salva l'evento con timestamp**
-    save_event(smartpot_id, alert_type)
+    return message
+
+def open_digest_window(smartpot_id, alert_type, now):
+    """Starts a new digest window for a SmartPot and issue, if the previous one has expired.
+       The window is stored in the digest_<alert_type> attribute of the SmartPot in the latest-value table
+       and claimed with a conditional update, so concurrent invocations agree on who delivers the alert.
+       Returns the expired window (None if there was none), or False if a window is still open."""
+
+    try:
+        response = dynamodb.update_item(
+            TableName=DYNAMODB_TABLE,
+            Key={"smartpot_id": {"S": smartpot_id}},
+            UpdateExpression="SET #digest = :window",
+            ConditionExpression="attribute_exists(smartpot_id) AND (attribute_not_exists(#digest) OR #digest.#until <= :now)",
+            ExpressionAttributeNames={"#digest": f"digest_{alert_type}", "#until": "until"},
+            ExpressionAttributeValues={
+                ":window": {"M": {
+                    "since": {"N": str(now)},
+                    "until": {"N": str(now + ALERT_DIGEST_WINDOW)},
+                    "count": {"N": "0"}
+                }},
+                ":now": {"N": str(now)}
+            },
+            ReturnValues="UPDATED_OLD"
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+    previous = response.get("Attributes", {}).get(f"digest_{alert_type}")
+    return previous["M"] if previous else None
+
+def add_to_digest(smartpot_id, alert_message, now):
+    """Adds a suppressed alert to the open digest window of its SmartPot and issue.
+       Returns False if the window expired meanwhile."""
 
-    # **Invio del messaggio Telegram**
-    send_telegram_message(message)
+    try:
+        dynamodb.update_item(
+            TableName=DYNAMODB_TABLE,
+            Key={"smartpot_id": {"S": smartpot_id}},
+            UpdateExpression="SET #digest.#count = #digest.#count + :one, #digest.#last = :last",
+            ConditionExpression="#digest.#until > :now",
+            ExpressionAttributeNames={"#digest": f"digest_{alert_message['issue']}", "#until": "until", "#count": "count", "#last": "last"},
+            ExpressionAttributeValues={
+                ":one": {"N": "1"},
+                ":last": {"S": json.dumps(alert_message)},
+                ":now": {"N": str(now)}
+            }
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+def close_digest_window(smartpot_id, alert_type, since):
+    """Closes the digest window opened at since, so the next alert is delivered immediately."""
+
+    try:
+        dynamodb.update_item(
+            TableName=DYNAMODB_TABLE,
+            Key={"smartpot_id": {"S": smartpot_id}},
+            UpdateExpression="SET #digest.#until = :since",
+            ConditionExpression="#digest.#since = :since",
+            ExpressionAttributeNames={"#digest": f"digest_{alert_type}", "#until": "until", "#since": "since"},
+            ExpressionAttributeValues={":since": {"N": str(since)}}
+        )
+    except Exception as e:
+        print(f"Error closing digest window for SmartPot {smartpot_id}: {e}")
+
+def end_digest_window(smartpot_id, alert_type, now):
+    """Ends the open digest window of a SmartPot and issue when the issue is resolved, so a new breach
+       is delivered immediately as a new incident. Alerts already suppressed in the window are still
+       reported, with the next alert or by flush_digests."""
+
+    try:
+        dynamodb.update_item(
+            TableName=DYNAMODB_TABLE,
+            Key={"smartpot_id": {"S": smartpot_id}},
+            UpdateExpression="SET #digest.#until = :now",
+            ConditionExpression="#digest.#until > :now",
+            ExpressionAttributeNames={"#digest": f"digest_{alert_type}", "#until": "until"},
+            ExpressionAttributeValues={":now": {"N": str(now)}}
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        pass  # Nessuna finestra aperta
+    except Exception as e:
+        print(f"Error ending digest window for SmartPot {smartpot_id}: {e}")
+
+def format_digest(smartpot_id, alert_type, window):
+    """Builds the Telegram summary of the alerts suppressed during a digest window."""
+
+    since = datetime.fromtimestamp(int(window["since"]["N"])).strftime("%H:%M")
+    message = f"🔁 {window['count']['N']} more {alert_type} alerts for SmartPot {smartpot_id} since {since}."
+    if "last" in window:
+        message += f"\nLatest:\n{format_alert(json.loads(window['last']['S']))}"
+    return message
+
+def deliver_alert(alert_message, deadline=None):
+    """Delivers an alert through the digest stage.
+       Critical alerts are always sent. The first alert of a SmartPot and issue opens a digest window
+       of ALERT_DIGEST_WINDOW seconds and is sent together with the summary of the previous window;
+       the repeated alerts within the window are only added to the digest.
+       A resolved issue (<issue>_resolved) is always sent and ends the digest window of <issue>.
+       Returns True if the alert was sent or merged into a digest, None if Telegram rejected it for good,
+       False if it must be retried (also when deadline passes before it is sent)."""
+
+    if deadline is not None and time.monotonic() >= deadline:
+        return False
+
+    smartpot_id = alert_message["smartpot_id"]
+    alert_type = alert_message.get("issue")
+    message = format_alert(alert_message)
+
+    if alert_type in CRITICAL_ALERTS or not alert_type:
+        return send_telegram_message(message, deadline)
+
+    now = int(time.time())
+    if alert_type.endswith("_resolved"):
+        end_digest_window(smartpot_id, alert_type[:-len("_resolved")], now)
+        return send_telegram_message(message, deadline)
+
+    try:
+        for _ in range(2):
+            previous = open_digest_window(smartpot_id, alert_type, now)
+            if previous is not False:
+                break
+            if add_to_digest(smartpot_id, alert_message, now):
+                return True
+        else:
+            return send_telegram_message(message, deadline)
+    except Exception as e:
+        print(f"Error updating alert digest for SmartPot {smartpot_id}: {e}")
+        return send_telegram_message(message, deadline)
+
+    if previous and int(previous["count"]["N"]):
+        message = f"{message}\n\n{format_digest(smartpot_id, alert_type, previous)}"
+
+    sent = send_telegram_message(message, deadline)
+    if sent is not False:
+        return sent
+
+    # Il messaggio verrà ritentato da SQS: la finestra non deve sopprimerlo
+    close_digest_window(smartpot_id, alert_type, now)
+    return False
+
+def flush_digests(deadline=None):
+    """Sends the summaries of the expired digest windows that still hold suppressed alerts.
+       Invoked on a schedule, so the repeated alerts of a SmartPot are reported even when no new alert arrives.
+       Each window is emptied with a conditional update before its summary is sent, so it is reported only once.
+       Windows not reached before deadline are left to the next run."""
+
+    now = int(time.time())
+    digests = []
+    paginator = dynamodb.get_paginator("scan")
+    for page in paginator.paginate(TableName=DYNAMODB_TABLE):
+        for item in page.get("Items", []):
+            for attribute, value in item.items():
+                window = value.get("M", {})
+                if attribute.startswith("digest_") and int(window["until"]["N"]) <= now and int(window["count"]["N"]):
+                    digests.append((item["smartpot_id"]["S"], attribute[len("digest_"):], window))
+
+    def flush(digest):
+        smartpot_id, alert_type, window = digest
+        if deadline is not None and time.monotonic() >= deadline:
+            return
+        try:
+            dynamodb.update_item(
+                TableName=DYNAMODB_TABLE,
+                Key={"smartpot_id": {"S": smartpot_id}},
+                UpdateExpression="SET #digest.#count = :zero",
+                ConditionExpression="#digest.#since = :since AND #digest.#count = :count",
+                ExpressionAttributeNames={"#digest": f"digest_{alert_type}", "#since": "since", "#count": "count"},
+                ExpressionAttributeValues={":zero": {"N": "0"}, ":since": window["since"], ":count": window["count"]}
+            )
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            return  # Già riassunta da un nuovo avviso
+        if not send_telegram_message(format_digest(smartpot_id, alert_type, window), deadline):
+            print(f"Error sending alert digest for SmartPot {smartpot_id}: {alert_type}")
+
+    with ThreadPoolExecutor(max_workers=TELEGRAM_WORKERS) as executor:
+        list(executor.map(flush, digests))
+
+def process_alerts(alerts, deadline=None):
+    """Processes a batch of (message_id, alert_message) pairs received from an SQS queue.
+       Delivers the alerts concurrently (at most TELEGRAM_WORKERS at a time) through the digest stage,
+       then counts the delivered or digested alerts in the hourly event counters.
+       Alerts rejected for good by Telegram are logged and acknowledged (still counted as events), not retried;
+       alerts not sent before deadline are returned for retry.
+       Returns the message ids of the alerts that failed and must be retried."""
+
+    alerts = [(message_id, alert_message) for message_id, alert_message in alerts if alert_message.get("smartpot_id")]
+
+    # **Invio dei messaggi Telegram**
+    with ThreadPoolExecutor(max_workers=TELEGRAM_WORKERS) as executor:
+        delivered = list(executor.map(lambda alert: deliver_alert(alert[1], deadline), alerts))
+
+    failed = [message_id for (message_id, _), sent in zip(alerts, delivered) if sent is False]
+
+    # **Conta gli eventi nei contatori orari**
+    failed.extend(save_events([alert for alert, sent in zip(alerts, delivered) if sent is not False]))
+    return failed
+
+def get_deadline(context):
+    """Returns the time.monotonic() by which the Telegram messages must be sent,
+       LAMBDA_TIME_MARGIN seconds before the Lambda timeout (None when invoked without a Lambda context)."""
+
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - LAMBDA_TIME_MARGIN
 
 def lambda_handler(event, context):
-    """AWS Lambda handler function to process alerts from SQS and send Telegram notifications."""
+    """AWS Lambda handler function to process alerts from SQS and send Telegram notifications.
+       Returns the failed records in batchItemFailures, so SQS only retries those.
+       Scheduled invocations (no Records) send the summaries of the expired alert digests."""
     
     os.putenv("TZ", "Europe/Rome")
     time.tzset()
+    deadline = get_deadline(context)
+
+    if "Records" not in event:
+        try:
+            flush_digests(deadline)
+        except Exception as e:
+            print(f"Error flushing alert digests: {e}")
+        return {"statusCode": 200, "body": json.dumps({"message": "Alert digests flushed"})}
 
+    records = event.get("Records", [])
     try:
-        if "Records" in event:
-            for record in event["Records"]:
-                alert_message = json.loads(record["body"])
-                process_alert(alert_message)
-        
-        return {
-            "statusCode": 200,
-            "body": json.dumps({"message": "Notifications sent successfully"})
-        }
+        alerts = []
+        failed = []
+        for record in records:
+            try:
+                alerts.append((record["messageId"], json.loads(record["body"])))
+            except Exception as e:
+                print(f"Error parsing alert {record.get('messageId')}: {e}")
+                failed.append(record["messageId"])
+
+        failed.extend(process_alerts(alerts, deadline))
 
     except Exception as e:
         print(f"Error in handleAlerts: {e}")
-        return {
-            "statusCode": 500,
-            "body": json.dumps({"error": str(e)})
-        }
+        failed = [record["messageId"] for record in records]
+
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed]}
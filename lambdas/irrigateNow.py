@@ -1,6 +1,9 @@
+import asyncio
 import json
 import os
+import threading
 import time
+import uuid
 import boto3
 import paho.mqtt.client as mqtt
 from datetime import datetime
@@ -17,6 +20,10 @@ MQTT_BROKER = os.getenv("MQTT_BROKER", "mosquitto-broker")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
 MQTT_TOPIC_COMMAND = os.getenv("MQTT_TOPIC_COMMAND", "Irrigation_Command")
 MQTT_TOPIC_CONFIRM = os.getenv("MQTT_TOPIC_CONFIRM", "Irrigation_Confirm")
+MQTT_CONNECT_TIMEOUT = 5  # Seconds
+IRRIGATION_CONFIRM_TIMEOUT = float(os.getenv("IRRIGATION_CONFIRM_TIMEOUT", "10"))  # Seconds
+LAMBDA_TIME_MARGIN = 2  # Seconds kept free before the Lambda timeout to record the outcomes
+IRRIGATION_MAX_RECEIVES = int(os.getenv("IRRIGATION_MAX_RECEIVES", "3"))  # maxReceiveCount of the irrigation queue
 
 # Initialize AWS Clients
 ENDPOINT_URL = f"http://{LOCALSTACK_HOSTNAME}:{EDGE_PORT}"
@@ -24,41 +31,104 @@ dynamodb = boto3.client("dynamodb", endpoint_url=ENDPOINT_URL, region_name=AWS_R
 sqs = boto3.client("sqs", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
 queue_url = sqs.get_queue_url(QueueName=SQS_ALERTS_QUEUE)["QueueUrl"]
 
-# Global variable for irrigation confirmation
-irrigation_confirmed = False
-
-# Configure MQTT Client
-client = mqtt.Client()
-client.max_inflight_messages_set(20)  # Aumenta il numero massimo di messaggi in volo
-
-def on_mqtt_message(client, userdata, msg):
-    """Handles incoming MQTT messages for irrigation confirmation.
-       If the message contains "status": "done", sets irrigation_confirmed = True."""
-    global irrigation_confirmed
-    try:
-        payload = json.loads(msg.payload.decode("utf-8"))
-        smartpot_id = payload.get("smartpot_id")
-        status = payload.get("status")
-
-        if status == "done":
-            irrigation_confirmed = True
-    except Exception as e:
-        print(f"Error processing MQTT confirmation message: {e}")
-
-def send_irrigation_command(smartpot_id):
-    """Sends an MQTT command to start irrigation.
-       Uses QoS 2 to guarantee exactly-once delivery.
-       Subscribes to the MQTT confirmation topic (Irrigation_Confirm)."""
+class IrrigationOrchestrator:
+    """Sends irrigation commands over one persistent MQTT connection and awaits their confirmations.
+       The connection is kept by the paho network thread (loop_start) for the life of the warm container,
+       which also reconnects and resubscribes to the confirmation topic after a disconnection.
+       Every command carries a correlation_id, echoed by the Arduino in its confirmation; confirmations
+       without one (older firmware) are matched to the oldest pending command of the same SmartPot."""
+
+    def __init__(self):
+        self.pending = {}  # correlation_id -> (smartpot_id, future, event loop)
+        self.lock = threading.Lock()
+        self.connected = threading.Event()
+
+        self.client = mqtt.Client()
+        self.client.max_inflight_messages_set(20)  # Aumenta il numero massimo di messaggi in volo
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
+        self.client.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        """Subscribes to the confirmation topic on every (re)connection."""
+        if rc == 0:
+            client.subscribe(MQTT_TOPIC_CONFIRM, qos=2)
+            self.connected.set()
+        else:
+            print(f"MQTT connection refused: rc={rc}")
+
+    def on_disconnect(self, client, userdata, rc):
+        """Marks the connection as lost; the network thread reconnects automatically."""
+        self.connected.clear()
+
+    def on_message(self, client, userdata, msg):
+        """Handles incoming MQTT messages for irrigation confirmation (paho network thread).
+           A message with "status": "done" resolves the future of the command it confirms."""
+        try:
+            payload = json.loads(msg.payload.decode("utf-8"))
+            if payload.get("status") != "done":
+                return
+
+            correlation_id = payload.get("correlation_id")
+            with self.lock:
+                if correlation_id is None:
+                    correlation_id = next((key for key, (smartpot_id, _, _) in self.pending.items()
+                                           if smartpot_id == payload.get("smartpot_id")), None)
+                command = self.pending.pop(correlation_id, None)
+
+            if command is not None:
+                _, future, loop = command
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+        except Exception as e:
+            print(f"Error processing MQTT confirmation message: {e}")
+
+    async def irrigate(self, smartpot_id, budget=MQTT_CONNECT_TIMEOUT + IRRIGATION_CONFIRM_TIMEOUT):
+        """Sends an MQTT command to start irrigation and waits for its confirmation.
+           Uses QoS 2 to guarantee exactly-once delivery. The wait for the MQTT connection and the wait for the
+           confirmation (at most IRRIGATION_CONFIRM_TIMEOUT) together never exceed budget seconds.
+           Returns True if the Arduino confirmed the irrigation, False if the command was sent but not confirmed
+           in time, None if it could not be sent (no MQTT connection)."""
+
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + budget
+        if not self.connected.is_set():
+            connect_timeout = max(0, min(MQTT_CONNECT_TIMEOUT, budget - 1))
+            if not await loop.run_in_executor(None, self.connected.wait, connect_timeout):
+                print(f"MQTT connection not available for {smartpot_id}")
+                return None
+
+        correlation_id = uuid.uuid4().hex
+        future = loop.create_future()
+        with self.lock:
+            self.pending[correlation_id] = (smartpot_id, future, loop)
 
-    client.connect(MQTT_BROKER, MQTT_PORT, 60)
-    client.subscribe(MQTT_TOPIC_CONFIRM, qos=2)
-    payload = json.dumps({"smartpot_id": smartpot_id, "action": "start"})
-    client.publish(MQTT_TOPIC_COMMAND, payload, qos=2)
-    send_alert(smartpot_id,"irrigation_triggered")
+        try:
+            payload = json.dumps({"smartpot_id": smartpot_id, "action": "start", "correlation_id": correlation_id})
+            self.client.publish(MQTT_TOPIC_COMMAND, payload, qos=2)
+            await loop.run_in_executor(None, send_alert, smartpot_id, "irrigation_triggered")
+            return await asyncio.wait_for(future, max(0, min(IRRIGATION_CONFIRM_TIMEOUT, deadline - time.monotonic())))
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self.lock:
+                self.pending.pop(correlation_id, None)
+
+# One orchestrator (and MQTT connection) per warm container
+orchestrator = None
+
+def get_orchestrator():
+    """Returns the irrigation orchestrator of the warm container, creating it on first use."""
+    global orchestrator
+
+    if orchestrator is None:
+        orchestrator = IrrigationOrchestrator()
+    return orchestrator
 
 def update_last_irrigation(smartpot_id):
     """Updates the last_irrigation timestamp in DynamoDB for the given SmartPot."""
-    
+
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     dynamodb.update_item(
         TableName=DYNAMODB_TABLE,
@@ -77,51 +147,102 @@ def send_alert(smartpot_id, issue_type):
     })
     sqs.send_message(QueueUrl=queue_url, MessageBody=alert_msg)
 
-def lambda_handler(event, context):
-    """AWS Lambda handler for irrigation activation."""
+async def irrigate_and_record(smartpot_id, budget, last_attempt=True):
+    """Irrigates a SmartPot and records the outcome.
+       On confirmation updates last_irrigation and sends irrigation_completed. A command sent but not confirmed
+       sends irrigation_error; a command that could not be sent only does so on the last attempt, as it is retried.
+       Returns the outcome of irrigate (a recording error must not make SQS irrigate again)."""
 
-    global irrigation_confirmed
-    irrigation_confirmed = False
+    loop = asyncio.get_running_loop()
+    confirmed = await get_orchestrator().irrigate(smartpot_id, budget)
+    try:
+        if confirmed:
+            await loop.run_in_executor(None, update_last_irrigation, smartpot_id)
+            await loop.run_in_executor(None, send_alert, smartpot_id, "irrigation_completed")
+        elif confirmed is False or last_attempt:
+            await loop.run_in_executor(None, send_alert, smartpot_id, "irrigation_error")
+    except Exception as e:
+        print(f"Error recording irrigation of {smartpot_id}: {e}")
+    return confirmed
+
+async def irrigate_all(smartpot_ids, budget=MQTT_CONNECT_TIMEOUT + IRRIGATION_CONFIRM_TIMEOUT, last_attempts=None):
+    """Irrigates several SmartPots at once: one command per distinct SmartPot, each pending with its own
+       correlation_id and timeout, so the whole batch completes within a single confirmation window.
+       last_attempts holds the SmartPots whose request will not be redelivered by SQS (None: all of them).
+       Returns {smartpot_id: outcome of irrigate}."""
+
+    smartpot_ids = list(dict.fromkeys(smartpot_ids))
+    results = await asyncio.gather(*(
+        irrigate_and_record(smartpot_id, budget, last_attempts is None or smartpot_id in last_attempts)
+        for smartpot_id in smartpot_ids
+    ))
+    return dict(zip(smartpot_ids, results))
+
+def get_time_budget(context):
+    """Returns the seconds available to connect and await the confirmations, leaving LAMBDA_TIME_MARGIN
+       seconds before the Lambda timeout (install.sh sets it to cover both waits plus the margin)."""
+
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return MQTT_CONNECT_TIMEOUT + IRRIGATION_CONFIRM_TIMEOUT
+    return max(1, context.get_remaining_time_in_millis() / 1000 - LAMBDA_TIME_MARGIN)
+
+def lambda_handler(event, context):
+    """AWS Lambda handler for irrigation activation.
+       For SQS batches, only the records whose command could not be sent are returned in batchItemFailures,
+       so SQS retries those (at most IRRIGATION_MAX_RECEIVES times, then the queue moves them to its DLQ).
+       A command sent but not confirmed is not retried, as the pot may have been irrigated anyway;
+       several records for the same SmartPot share one command."""
 
     os.putenv('TZ', 'Europe/Rome')
     time.tzset()
 
-    try:
-        smartpot_id = None
+    if "Records" in event:  # Triggered by SQS (processSensorData detected dry soil)
+        pots_by_record = {}
+        last_attempts = set()
+        failed = []
+        for record in event["Records"]:
+            try:
+                smartpot_id = json.loads(record["body"]).get("smartpot_id")
+                if not smartpot_id:
+                    raise ValueError("smartpot_id is required")
+                pots_by_record[record["messageId"]] = smartpot_id
+                if int(record.get("attributes", {}).get("ApproximateReceiveCount", "1")) >= IRRIGATION_MAX_RECEIVES:
+                    last_attempts.add(smartpot_id)
+            except Exception as e:
+                print(f"Error parsing irrigation request {record.get('messageId')}: {e}")
+                failed.append(record["messageId"])
 
-        if "Records" in event:  # Triggered by SQS (processSensorData detected dry soil)
-            for record in event["Records"]:
-                message = json.loads(record["body"])
-                smartpot_id = message.get("smartpot_id")
-                send_irrigation_command(smartpot_id)
+        try:
+            results = asyncio.run(irrigate_all(pots_by_record.values(), get_time_budget(context), last_attempts))
+            for smartpot_id, confirmed in results.items():
+                if confirmed is False:
+                    print(f"Irrigation of {smartpot_id} not confirmed within {IRRIGATION_CONFIRM_TIMEOUT}s. Not retried.")
+            failed.extend(message_id for message_id, smartpot_id in pots_by_record.items() if results[smartpot_id] is None)
+        except Exception as e:
+            print(f"Error in irrigateNow: {e}")
+            failed.extend(pots_by_record)
 
-        elif event.get("httpMethod") == "POST":  # Triggered manually via API Gateway (Bot Telegram)
-            body = json.loads(event["body"])
-            smartpot_id = body.get("smartpot_id")
-            if not smartpot_id:
-                return {"statusCode": 400, "body": json.dumps({"error": "smartpot_id is required"})}
+        return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed]}
 
-            send_irrigation_command(smartpot_id)
+    try:
+        if event.get("httpMethod") != "POST":
+            return {"statusCode": 400, "body": json.dumps({"error": "Unsupported request"})}
 
-        client.on_message = on_mqtt_message
+        # Triggered manually via API Gateway (Bot Telegram)
+        body = json.loads(event["body"])
+        smartpot_id = body.get("smartpot_id")
+        if not smartpot_id:
+            return {"statusCode": 400, "body": json.dumps({"error": "smartpot_id is required"})}
 
-        try:
-            client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        except Exception as e:
-            return {"statusCode": 500, "body": json.dumps({"error": "MQTT connection failed"})}
+        results = asyncio.run(irrigate_all([smartpot_id], get_time_budget(context)))
 
-        client.subscribe(MQTT_TOPIC_CONFIRM, qos=2)
+        if results[smartpot_id]:
+            return {"statusCode": 200, "body": json.dumps({"message": "Irrigation completed successfully"})}
 
-        for _ in range(20):
-            client.loop()
-            if irrigation_confirmed:
-                update_last_irrigation(smartpot_id)
-                send_alert(smartpot_id, "irrigation_completed")
-                return {"statusCode": 200, "body": json.dumps({"message": "Irrigation completed successfully"})}
-            time.sleep(0.5)
+        if results[smartpot_id] is None:
+            return {"statusCode": 503, "body": json.dumps({"error": "MQTT broker not reachable"})}
 
-        # After 10 seconds, it sends an error
-        send_alert(smartpot_id, "irrigation_error")
+        # Nessuna conferma entro IRRIGATION_CONFIRM_TIMEOUT secondi
         return {"statusCode": 500, "body": json.dumps({"error": "Irrigation confirmation not received"})}
 
     except Exception as e:
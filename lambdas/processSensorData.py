@@ -1,7 +1,12 @@
 import base64
 import json
 import os
+import struct
+import sys
 import time
+import operator
+import zlib
+from array import array
 from datetime import datetime, timezone
 from dataclasses import dataclass
 import boto3
@@ -13,6 +18,8 @@ class SensorData:
     temperature: str
     humidity: str
     soil_moisture: str
+    summarized: bool = False  # Built from an edge summary, whose statistics reach the rollups on their own
+    measure_ts: int = None  # Seconds since the epoch of measure_date, sent by the bridge (absent in older records)
 
 # Load environment variables
 LOCALSTACK_HOSTNAME = os.getenv("LOCALSTACK_HOSTNAME", "localhost")
@@ -27,13 +34,33 @@ s3 = boto3.client("s3", endpoint_url=ENDPOINT_URL, region_name=AWS_REGION)
 
 # Configurations
 DYNAMODB_TABLE = os.getenv("DYNAMODB_TABLE", "SmartPotData")
+DYNAMODB_ROLLUPS_TABLE = os.getenv("DYNAMODB_ROLLUPS_TABLE", "SmartPotRollups")
+ROLLUP_MAX_RETRIES = 5
 SQS_ALERTS_QUEUE = os.getenv("SQS_ALERTS_QUEUE", "SmartPotAlertsQueue")
 SQS_IRRIGATION_QUEUE = os.getenv("SQS_IRRIGATION_QUEUE", "SmartPotIrrigationQueue")
 S3_BUCKET = os.getenv("S3_BUCKET", "smartpotsystem-s3-bucket")
 RAW_DATA_FOLDER = "raw"
+RAW_DATA_FORMAT = os.getenv("RAW_DATA_FORMAT", "columnar")  # "columnar" (.spc) or "jsonl"
+SQS_BATCH_SIZE = 10  # Maximum number of entries accepted by send_message_batch
+IRRIGATION_COOLDOWN_MINUTES = float(os.getenv("IRRIGATION_COOLDOWN_MINUTES", "5"))  # Default, overridable per pot
+IRRIGATION_STATE_TTL = int(os.getenv("IRRIGATION_STATE_TTL", "60"))  # Seconds
+IRRIGATION_MAX_READING_AGE = float(os.getenv("IRRIGATION_MAX_READING_AGE", "15"))  # Minutes; older (replayed) readings never irrigate, 0 disables the check
+RULES_CONFIG_KEY = os.getenv("RULES_CONFIG_KEY", "config/plant_limits.json")
+RULES_REFRESH_SECONDS = int(os.getenv("RULES_REFRESH_SECONDS", "60"))
+ALERT_REALERT_MINUTES = float(os.getenv("ALERT_REALERT_MINUTES", "60"))  # Reminder interval of an alert still active
+ALERT_STATE_TTL = int(os.getenv("ALERT_STATE_TTL", "60"))  # Seconds
+METRICS = ["temperature", "humidity", "soil_moisture"]
 
-# Limits for plants
-PLANT_LIMITS = {
+# Distance from a limit a value must recover before its alert is cleared, unless "<metric>_deadband" is configured
+DEFAULT_DEADBANDS = {"temperature": 1, "humidity": 3, "soil_moisture": 3}
+
+# Columnar raw segments: magic, pot id length, row count, first and last timestamp
+SEGMENT_MAGIC = b"SPC1"
+SEGMENT_HEADER = struct.Struct("<4sHIqq")
+EPOCH = datetime(1970, 1, 1)
+
+# Built-in limits for plants, used until a configuration object is available in S3
+DEFAULT_PLANT_LIMITS = {
     "Strawberry": {
         "temperature_min": 18, "temperature_max": 30,
         "humidity_min": 50, "humidity_max": 80,
@@ -46,10 +73,99 @@ PLANT_LIMITS = {
     }
 }
 
+# Warm-container cache of the irrigation state of each pot, refreshed by every latest-value update
+irrigation_state = {}
+
+# Warm-container cache of the active alerts of each pot ({issue: epoch of the last alert}), stored in alert_state
+alert_states = {}
+
+# Warm-container cache of the compiled threshold rules
+rule_engine = None
+rules_checked_at = 0
+
+def get_latest_readings(readings):
+    """Reduces a Kinesis batch to the newest reading of each SmartPot, compared by measure_date.
+       Only these readings need to reach the latest-value table."""
+
+    latest = {}
+    for _, sensor_data in readings:
+        current = latest.get(sensor_data.smartpot_id)
+        if current is None or sensor_data.measure_date >= current.measure_date:
+            latest[sensor_data.smartpot_id] = sensor_data
+    return list(latest.values())
+
+def cache_irrigation_state(smartpot_id, item):
+    """Caches the irrigation state of a SmartPot from a DynamoDB item.
+       Stores last_irrigation, the measure_date of the stored reading and the pot's irrigation_cooldown (minutes),
+       falling back to IRRIGATION_COOLDOWN_MINUTES when the pot does not define one."""
+
+    irrigation_state[smartpot_id] = {
+        "last_irrigation": item.get("last_irrigation", {}).get("S"),
+        "measure_date": item.get("measure_date", {}).get("S"),
+        "cooldown_minutes": float(item.get("irrigation_cooldown", {}).get("N", IRRIGATION_COOLDOWN_MINUTES)),
+        "cached_at": time.time()
+    }
+
+def get_irrigation_state(smartpot_id):
+    """Returns the cached irrigation state of a SmartPot.
+       The cache is normally filled by save_to_dynamodb in the same batch;
+       DynamoDB is only read when the entry is missing or older than IRRIGATION_STATE_TTL."""
+
+    state = irrigation_state.get(smartpot_id)
+    if state is None or time.time() - state["cached_at"] > IRRIGATION_STATE_TTL:
+        response = dynamodb.get_item(
+            TableName=DYNAMODB_TABLE,
+            Key={"smartpot_id": {"S": smartpot_id}},
+            ProjectionExpression="last_irrigation, irrigation_cooldown, measure_date"
+        )
+        cache_irrigation_state(smartpot_id, response.get("Item", {}))
+        state = irrigation_state[smartpot_id]
+    return state
+
+def cache_alert_state(smartpot_id, item):
+    """Caches the active alerts of a SmartPot from the alert_state map of a DynamoDB item."""
+
+    alert_states[smartpot_id] = {
+        "alerts": {issue: int(value["N"]) for issue, value in item.get("alert_state", {}).get("M", {}).items()},
+        "cached_at": time.time()
+    }
+
+def get_alert_state(smartpot_id):
+    """Returns the cached active alerts of a SmartPot as {issue: epoch of the last alert}.
+       The cache is normally filled by save_to_dynamodb in the same batch;
+       DynamoDB is only read when the entry is missing or older than ALERT_STATE_TTL."""
+
+    state = alert_states.get(smartpot_id)
+    if state is None or time.time() - state["cached_at"] > ALERT_STATE_TTL:
+        response = dynamodb.get_item(
+            TableName=DYNAMODB_TABLE,
+            Key={"smartpot_id": {"S": smartpot_id}},
+            ProjectionExpression="alert_state"
+        )
+        cache_alert_state(smartpot_id, response.get("Item", {}))
+        state = alert_states[smartpot_id]
+    return state["alerts"]
+
+def save_alert_state(smartpot_id, alerts):
+    """Stores the active alerts of a SmartPot in its alert_state attribute (only called on state transitions)."""
+
+    try:
+        dynamodb.update_item(
+            TableName=DYNAMODB_TABLE,
+            Key={"smartpot_id": {"S": smartpot_id}},
+            UpdateExpression="SET alert_state = :state",
+            ExpressionAttributeValues={":state": {"M": {issue: {"N": str(value)} for issue, value in alerts.items()}}}
+        )
+        alert_states[smartpot_id] = {"alerts": alerts, "cached_at": time.time()}
+    except Exception as e:
+        print(f"Error saving alert state for {smartpot_id}: {e}")
+
 def save_to_dynamodb(sensor_data: SensorData):
     """Saves sensor data into a DynamoDB table.
-       Uses an UPDATE operation to store the latest
-       measurement values for a given smartpot_id."""
+       Uses a conditional UPDATE operation to store the latest
+       measurement values for a given smartpot_id, never replacing
+       a newer measure_date with an older one.
+       The item returned by the update refreshes the irrigation and alert state caches."""
     try:
         
         update_expression = "SET measure_date = :m, temperature = :t, humidity = :h, soil_moisture = :s"
@@ -60,155 +176,470 @@ def save_to_dynamodb(sensor_data: SensorData):
             ":s": {"S": sensor_data.soil_moisture}
         }
 
-        dynamodb.update_item(
+        response = dynamodb.update_item(
             TableName=DYNAMODB_TABLE,
             Key={"smartpot_id": {"S": sensor_data.smartpot_id}},
             UpdateExpression=update_expression,
-            ExpressionAttributeValues=expression_values
+            ConditionExpression="attribute_not_exists(measure_date) OR measure_date <= :m",
+            ExpressionAttributeValues=expression_values,
+            ReturnValues="ALL_NEW",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD"
         )
+        cache_irrigation_state(sensor_data.smartpot_id, response.get("Attributes", {}))
+        cache_alert_state(sensor_data.smartpot_id, response.get("Attributes", {}))
 
+    except dynamodb.exceptions.ConditionalCheckFailedException as e:
+        print(f"Skipping DynamoDB update for {sensor_data.smartpot_id}: a newer measurement is already stored")
+        if e.response.get("Item"):
+            cache_irrigation_state(sensor_data.smartpot_id, e.response["Item"])
+            cache_alert_state(sensor_data.smartpot_id, e.response["Item"])
     except Exception as e:
         print(f"Error saving to DynamoDB: {e}")
 
-def save_to_s3(sensor_data: SensorData):
-    """Saves raw sensor data into an S3 bucket, structured by date.
+def encode_columnar_segment(smartpot_id, rows):
+    """Encodes raw readings as a columnar segment (.spc).
+       rows is a list of (timestamp, temperature, humidity, soil_moisture), with timestamps
+       in seconds since the epoch of the local measure_date.
+       Layout: SEGMENT_HEADER, the smartpot_id, then a zlib-compressed block holding the
+       timestamp column (int64) followed by the three metric columns (float64), all little-endian."""
+
+    rows = sorted(rows)
+    columns = [array("q", [row[0] for row in rows])]
+    columns.extend(array("d", [row[index] for row in rows]) for index in range(1, 4))
+    if sys.byteorder != "little":
+        for column in columns:
+            column.byteswap()
+
+    encoded_id = smartpot_id.encode("utf-8")
+    header = SEGMENT_HEADER.pack(SEGMENT_MAGIC, len(encoded_id), len(rows), rows[0][0], rows[-1][0])
+    return header + encoded_id + zlib.compress(b"".join(column.tobytes() for column in columns))
+
+def save_to_s3(readings):
+    """Saves a Kinesis batch of raw sensor data into an S3 bucket, structured by date and SmartPot.
        Skips records containing "ERR" values.
-       If the file for the day already exists, it appends the new entry."""
-    if "ERR" in [sensor_data.temperature, sensor_data.humidity, sensor_data.soil_moisture]:
-        return
-    
-    today = datetime.now().strftime("%Y-%m-%d")
-    file_key = f"{RAW_DATA_FOLDER}/{today}/{sensor_data.smartpot_id}.json"
-
-    new_entry = {
-        "smartpot_id": sensor_data.smartpot_id,
-        "measure_date": sensor_data.measure_date,
-        "temperature": sensor_data.temperature,
-        "humidity": sensor_data.humidity,
-        "soil_moisture": sensor_data.soil_moisture
-    }
+       Each batch is written as a new segment in the hourly partition of its readings
+       (raw/<date>/<HH>/<smartpot_id>/<sequence>.spc, or .jsonl
+       when RAW_DATA_FORMAT is "jsonl"), named after the Kinesis sequence number of its first reading,
+       so no existing object is rewritten."""
 
-    try:
-        obj = s3.get_object(Bucket=S3_BUCKET, Key=file_key)
-        existing_data = json.loads(obj["Body"].read().decode("utf-8"))
-    except s3.exceptions.NoSuchKey:
-        existing_data = []
-
-    existing_data.append(new_entry)
-    s3.put_object(Bucket=S3_BUCKET, Key=file_key, Body=json.dumps(existing_data))
-
-def check_and_trigger(sensor_data: SensorData):
-    """Checks if sensor values exceed defined thresholds and triggers alerts and irrigation."""
-    smartpot_id = sensor_data.smartpot_id
-    limits = PLANT_LIMITS.get(smartpot_id, {})
-    current_time = datetime.now()
-    
-    # **Gestione errori sensori**
-    if "ERR" in [sensor_data.temperature, sensor_data.humidity, sensor_data.soil_moisture]:
-        alert_msg = json.dumps({
-            "smartpot_id": smartpot_id,
-            "issue": "sensor_error",
-            "details": {
-                "temperature": sensor_data.temperature,
-                "humidity": sensor_data.humidity,
-                "soil_moisture": sensor_data.soil_moisture
-            }
+    segments = {}
+    for sequence_number, sensor_data in readings:
+        if "ERR" in [sensor_data.temperature, sensor_data.humidity, sensor_data.soil_moisture]:
+            continue
+
+        try:
+            measure_time = datetime.strptime(sensor_data.measure_date, "%Y-%m-%d %H:%M:%S")
+            row = (int((measure_time - EPOCH).total_seconds()), float(sensor_data.temperature),
+                   float(sensor_data.humidity), float(sensor_data.soil_moisture))
+        except ValueError:
+            print(f"Skipping raw data for {sensor_data.smartpot_id}: Invalid reading {sensor_data}")
+            continue
+
+        segment = segments.setdefault((measure_time.strftime("%Y-%m-%d/%H"), sensor_data.smartpot_id),
+                                      {"sequence": sequence_number, "rows": [], "entries": []})
+        segment["rows"].append(row)
+        segment["entries"].append({
+            "smartpot_id": sensor_data.smartpot_id,
+            "measure_date": sensor_data.measure_date,
+            "temperature": sensor_data.temperature,
+            "humidity": sensor_data.humidity,
+            "soil_moisture": sensor_data.soil_moisture
         })
-        sqs.send_message(QueueUrl=SQS_ALERTS_QUEUE, MessageBody=alert_msg)
-        return  
 
-    # **Gestione temperatura**
-    try:
-        temperature_value = float(sensor_data.temperature)
-        if temperature_value < limits["temperature_min"]:
-            alert_msg = json.dumps({
-                "smartpot_id": smartpot_id,
-                "issue": "temperature_low",
-                "details": {"temperature": sensor_data.temperature}
-            })
-            sqs.send_message(QueueUrl=SQS_ALERTS_QUEUE, MessageBody=alert_msg)
-
-        elif temperature_value > limits["temperature_max"]:
-            alert_msg = json.dumps({
-                "smartpot_id": smartpot_id,
-                "issue": "temperature_high",
-                "details": {"temperature": sensor_data.temperature}
-            })
-            sqs.send_message(QueueUrl=SQS_ALERTS_QUEUE, MessageBody=alert_msg)
-
-    except ValueError:
-        print(f"Skipping temperature check for {smartpot_id}: Invalid value '{sensor_data.temperature}'")
-
-    # **Gestione umidità**
-    try:
-        humidity_value = float(sensor_data.humidity)
-        if humidity_value < limits["humidity_min"] or humidity_value > limits["humidity_max"]:
-            alert_type = "humidity_low" if humidity_value < limits["humidity_min"] else "humidity_high"
-            alert_msg = json.dumps({
-                "smartpot_id": smartpot_id,
-                "issue": alert_type,
-                "details": {"humidity": sensor_data.humidity}
-            })
-            sqs.send_message(QueueUrl=SQS_ALERTS_QUEUE, MessageBody=alert_msg)
-
-    except ValueError:
-        print(f"Skipping humidity check for {smartpot_id}: Invalid value '{sensor_data.humidity}'")
-
-    # **Gestione soil moisture**
+    for (partition, smartpot_id), segment in segments.items():
+        if RAW_DATA_FORMAT == "jsonl":
+            file_key = f"{RAW_DATA_FOLDER}/{partition}/{smartpot_id}/{segment['sequence']}.jsonl"
+            body = "\n".join(json.dumps(entry) for entry in segment["entries"])
+        else:
+            file_key = f"{RAW_DATA_FOLDER}/{partition}/{smartpot_id}/{segment['sequence']}.spc"
+            body = encode_columnar_segment(smartpot_id, segment["rows"])
+        try:
+            s3.put_object(Bucket=S3_BUCKET, Key=file_key, Body=body)
+        except Exception as e:
+            print(f"Error saving raw segment {file_key} to S3: {e}")
+
+def build_rollups(readings):
+    """Aggregates a batch of readings into hourly rollups.
+       Returns {(smartpot_id, hour): {metric: [count, sum, min, max, sum_of_squares]}},
+       where hour is "YYYY-MM-DD HH". Records containing "ERR" values are skipped, as in the raw data."""
+
+    rollups = {}
+    for sensor_data in readings:
+        try:
+            values = {metric: float(getattr(sensor_data, metric)) for metric in METRICS}
+            hour = datetime.strptime(sensor_data.measure_date, "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d %H")
+        except ValueError:
+            continue
+
+        stats = rollups.setdefault((sensor_data.smartpot_id, hour), {})
+        for metric, value in values.items():
+            merge_rollup_stats(stats, metric, [1, value, value, value, value * value])
+    return rollups
+
+def get_summary_extremes(summaries):
+    """Builds two readings per edge summary, with the minimum and with the maximum of each metric,
+       so the threshold rules also see the values reached inside the summarized interval, not only the last one."""
+
+    extremes = []
+    for summary in summaries:
+        try:
+            for statistic in ("min", "max"):
+                extremes.append(SensorData(
+                    smartpot_id=summary["smartpot_id"],
+                    measure_date=summary["measure_date"],
+                    measure_ts=summary.get("measure_ts"),
+                    summarized=True,
+                    **{metric: str(summary[metric][statistic]) for metric in METRICS}
+                ))
+        except (KeyError, TypeError) as e:
+            print(f"Skipping extremes of the summary of {summary.get('smartpot_id')}: {e}")
+    return extremes
+
+def merge_summary_rollups(rollups, summaries):
+    """Merges the statistics of edge summaries (record_type "summary", sent by the MQTT bridge in edge mode)
+       into the hourly rollups of a batch. A summary never spans two hours, so it belongs to the hour of its measure_date."""
+
+    for summary in summaries:
+        try:
+            hour = datetime.strptime(summary["measure_date"], "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d %H")
+            stats = rollups.setdefault((summary["smartpot_id"], hour), {})
+            for metric in METRICS:
+                values = summary.get(metric)
+                if values and values["count"]:
+                    merge_rollup_stats(stats, metric, [int(values["count"]), float(values["mean"]) * int(values["count"]),
+                                                       float(values["min"]), float(values["max"]), float(values["sum_sq"])])
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Skipping invalid summary of {summary.get('smartpot_id')}: {e}")
+
+def merge_rollup_stats(stats, metric, other):
+    """Merges [count, sum, min, max, sum_of_squares] statistics into stats[metric]."""
+
+    current = stats.get(metric)
+    if current is None:
+        stats[metric] = list(other)
+    else:
+        stats[metric] = [current[0] + other[0], current[1] + other[1],
+                         min(current[2], other[2]), max(current[3], other[3]), current[4] + other[4]]
+
+def rollup_stats_from_item(item):
+    """Converts the metric attributes of a DynamoDB rollup item into statistics lists."""
+
+    stats = {}
+    for metric in METRICS:
+        if metric in item:
+            value = item[metric]["M"]
+            stats[metric] = [int(value["count"]["N"]), float(value["sum"]["N"]), float(value["min"]["N"]),
+                             float(value["max"]["N"]), float(value["sum_sq"]["N"])]
+    return stats
+
+def rollup_stats_to_attribute(values):
+    """Converts a statistics list into a DynamoDB map attribute."""
+
+    count, total, minimum, maximum, sum_sq = values
+    return {"M": {
+        "count": {"N": str(count)},
+        "sum": {"N": repr(total)},
+        "min": {"N": repr(minimum)},
+        "max": {"N": repr(maximum)},
+        "sum_sq": {"N": repr(sum_sq)}
+    }}
+
+def save_rollups(rollups):
+    """Merges the hourly rollups of a batch into the rollups table.
+       Each (smartpot_id, hour) item is read, merged and written back with an optimistic
+       version check, retrying when another invocation updated it in the meantime."""
+
+    for (smartpot_id, hour), batch_stats in rollups.items():
+        key = {"smartpot_id": {"S": smartpot_id}, "hour": {"S": hour}}
+        try:
+            for _ in range(ROLLUP_MAX_RETRIES):
+                response = dynamodb.get_item(TableName=DYNAMODB_ROLLUPS_TABLE, Key=key, ConsistentRead=True)
+                item = response.get("Item", {})
+                version = int(item.get("version", {}).get("N", "0"))
+
+                stats = rollup_stats_from_item(item)
+                for metric, values in batch_stats.items():
+                    merge_rollup_stats(stats, metric, values)
+
+                expression_names = {f"#{metric}": metric for metric in stats}
+                expression_names["#version"] = "version"
+                expression_values = {f":{metric}": rollup_stats_to_attribute(values) for metric, values in stats.items()}
+                expression_values[":version"] = {"N": str(version + 1)}
+                expression_values[":current"] = {"N": str(version)}
+
+                try:
+                    dynamodb.update_item(
+                        TableName=DYNAMODB_ROLLUPS_TABLE,
+                        Key=key,
+                        UpdateExpression="SET " + ", ".join(f"#{metric} = :{metric}" for metric in stats) + ", #version = :version",
+                        ConditionExpression="attribute_not_exists(#version) OR #version = :current",
+                        ExpressionAttributeNames=expression_names,
+                        ExpressionAttributeValues=expression_values
+                    )
+                    break
+                except dynamodb.exceptions.ConditionalCheckFailedException:
+                    continue
+            else:
+                print(f"Error saving rollup for {smartpot_id} at {hour}: too many concurrent updates")
+
+        except Exception as e:
+            print(f"Error saving rollup for {smartpot_id} at {hour}: {e}")
+
+class MessageOutbox:
+    """Collects the SQS messages produced while processing a Kinesis batch.
+       Messages are deduplicated per (queue, smartpot_id, issue), keeping the most recent details,
+       and are sent with send_message_batch in groups of SQS_BATCH_SIZE."""
+
+    def __init__(self):
+        self.messages = {}
+
+    def add(self, queue, message):
+        """Queues a message, replacing any pending one for the same SmartPot and issue."""
+        key = (queue, message["smartpot_id"], message.get("issue", "irrigation"))
+        self.messages[key] = message
+
+    def flush(self):
+        """Sends every pending message and empties the outbox."""
+        messages_by_queue = {}
+        for (queue, _, _), message in self.messages.items():
+            messages_by_queue.setdefault(queue, []).append(message)
+        self.messages = {}
+
+        for queue, messages in messages_by_queue.items():
+            for start in range(0, len(messages), SQS_BATCH_SIZE):
+                entries = [
+                    {"Id": str(index), "MessageBody": json.dumps(message)}
+                    for index, message in enumerate(messages[start:start + SQS_BATCH_SIZE])
+                ]
+                try:
+                    response = sqs.send_message_batch(QueueUrl=queue, Entries=entries)
+                    for failed in response.get("Failed", []):
+                        print(f"Error sending message to {queue}: {failed.get('Message')}")
+                except Exception as e:
+                    print(f"Error sending message batch to {queue}: {e}")
+
+class RuleEngine:
+    """Threshold rules compiled from the plant limits configuration.
+       Limits are resolved from the "pots" section (optionally naming a "species" and
+       overriding single limits), then from the species named like the pot, then from "default".
+       Each pot's limits are compiled once into a tuple of (metric, comparison, threshold, issue, clear comparison,
+       clear threshold): an alert is raised beyond the limit and only cleared once the value is back inside it
+       by the metric's deadband."""
+
+    def __init__(self, config, version):
+        self.version = version
+        self.species = config.get("species", {})
+        self.pots = config.get("pots", {})
+        self.default = config.get("default", {})
+        self.compiled = {}
+
+    def get_limits(self, smartpot_id):
+        """Returns the merged limits that apply to a SmartPot (empty if none are configured)."""
+        pot_config = self.pots.get(smartpot_id, {})
+        limits = dict(self.species.get(pot_config.get("species", smartpot_id), self.default))
+        limits.update({key: value for key, value in pot_config.items() if key != "species"})
+        return limits
+
+    def get_rules(self, smartpot_id):
+        """Returns the compiled rules of a SmartPot, compiling them on first use."""
+        rules = self.compiled.get(smartpot_id)
+        if rules is None:
+            limits = self.get_limits(smartpot_id)
+            rules = []
+            for metric in METRICS:
+                deadband = float(limits.get(f"{metric}_deadband", DEFAULT_DEADBANDS[metric]))
+                if f"{metric}_min" in limits:
+                    threshold = float(limits[f"{metric}_min"])
+                    rules.append((metric, operator.lt, threshold, f"{metric}_low", operator.ge, threshold + deadband))
+                if f"{metric}_max" in limits:
+                    threshold = float(limits[f"{metric}_max"])
+                    rules.append((metric, operator.gt, threshold, f"{metric}_high", operator.le, threshold - deadband))
+            rules = tuple(rules)
+            self.compiled[smartpot_id] = rules
+        return rules
+
+    def evaluate(self, readings):
+        """Evaluates a batch of readings against the compiled rules.
+           Returns a list of (sensor_data, issue, details, breached) for every rule, where breached is True
+           beyond the limit, False once the value has cleared the deadband and None inside the deadband.
+           Readings containing "ERR" only produce a sensor_error."""
+
+        results = []
+        for sensor_data in readings:
+            if "ERR" in [sensor_data.temperature, sensor_data.humidity, sensor_data.soil_moisture]:
+                results.append((sensor_data, "sensor_error", {
+                    "temperature": sensor_data.temperature,
+                    "humidity": sensor_data.humidity,
+                    "soil_moisture": sensor_data.soil_moisture
+                }, True))
+                continue
+            results.append((sensor_data, "sensor_error", {}, False))
+
+            values = {}
+            for metric, compare, threshold, issue, clear, clear_threshold in self.get_rules(sensor_data.smartpot_id):
+                if metric not in values:
+                    try:
+                        values[metric] = float(getattr(sensor_data, metric))
+                    except ValueError:
+                        print(f"Skipping {metric} check for {sensor_data.smartpot_id}: Invalid value '{getattr(sensor_data, metric)}'")
+                        values[metric] = None
+                if values[metric] is None:
+                    continue
+                if compare(values[metric], threshold):
+                    breached = True
+                elif clear(values[metric], clear_threshold):
+                    breached = False
+                else:
+                    breached = None
+                results.append((sensor_data, issue, {metric: getattr(sensor_data, metric)}, breached))
+        return results
+
+def get_rule_engine():
+    """Returns the rule engine cached in the warm container.
+       Every RULES_REFRESH_SECONDS the configuration object's ETag is checked in S3
+       and the rules are reloaded only when it changed.
+       Falls back to DEFAULT_PLANT_LIMITS while no configuration is available."""
+    global rule_engine, rules_checked_at
+
+    if rule_engine is not None and time.time() - rules_checked_at < RULES_REFRESH_SECONDS:
+        return rule_engine
+
+    rules_checked_at = time.time()
     try:
-        soil_moisture_value = float(sensor_data.soil_moisture)
-        if soil_moisture_value < limits["soil_moisture_min"]:
-            # **Verifica l'ultima irrigazione nel database**
+        head = s3.head_object(Bucket=S3_BUCKET, Key=RULES_CONFIG_KEY)
+        if rule_engine is None or rule_engine.version != head["ETag"]:
+            obj = s3.get_object(Bucket=S3_BUCKET, Key=RULES_CONFIG_KEY)
+            rule_engine = RuleEngine(json.loads(obj["Body"].read().decode("utf-8")), obj["ETag"])
+            print(f"Loaded plant limits configuration {RULES_CONFIG_KEY} (version {obj['ETag']})")
+    except Exception as e:
+        if rule_engine is None:
+            print(f"Plant limits configuration not available ({e}). Using built-in limits.")
+            rule_engine = RuleEngine({"species": DEFAULT_PLANT_LIMITS}, None)
+    return rule_engine
+
+def check_and_trigger(readings, outbox: MessageOutbox):
+    """Checks a batch of readings against the plant limits and queues alerts and irrigation in the outbox.
+       Alerts follow a per-pot state machine: an alert is sent when its issue becomes active, again every
+       ALERT_REALERT_MINUTES while it stays active, and a <issue>_resolved notification is sent when the value
+       clears the deadband. Readings that do not change the state produce no message.
+       Irrigation is only requested from a pot's latest stored reading, and never from readings older than
+       IRRIGATION_MAX_READING_AGE minutes. The age comes from the epoch measure_ts sent by the bridge, so it does
+       not depend on the time zone of the bridge; readings without it are not checked."""
+    current_time = datetime.now()
+    now = int(time.time())
+    changed = {}
+
+    readings = sorted(readings, key=lambda sensor_data: sensor_data.measure_date)
+    for sensor_data, issue, details, breached in get_rule_engine().evaluate(readings):
+        smartpot_id = sensor_data.smartpot_id
+
+        # **Soil moisture bassa: irrigazione invece di un alert**
+        if issue == "soil_moisture_low":
+            if not breached:
+                continue
+
+            # **Letture vecchie (es. reinviate dallo spool del bridge dopo un'interruzione): niente irrigazione**
+            if IRRIGATION_MAX_READING_AGE > 0 and sensor_data.measure_ts is not None:
+                age = now - int(sensor_data.measure_ts)
+                if age > IRRIGATION_MAX_READING_AGE * 60:
+                    print(f"Skipping irrigation of {smartpot_id}: reading of {sensor_data.measure_date} is {age // 60} minutes old "
+                          f"(IRRIGATION_MAX_READING_AGE={IRRIGATION_MAX_READING_AGE:g}); check the bridge clock if it is not a replay")
+                    continue
+
+            # **Verifica l'ultima irrigazione (dalla cache aggiornata da save_to_dynamodb)**
             try:
-                response = dynamodb.get_item(
-                    TableName=DYNAMODB_TABLE,
-                    Key={"smartpot_id": {"S": smartpot_id}},
-                    AttributesToGet=["last_irrigation"]
-                )
-                last_irrigation = response.get("Item", {}).get("last_irrigation", {}).get("S", None)
+                state = get_irrigation_state(smartpot_id)
+                if state["measure_date"] and sensor_data.measure_date < state["measure_date"]:
+                    continue  # Una lettura più recente è già memorizzata: decide quella
+                last_irrigation = state["last_irrigation"]
 
                 if last_irrigation:
-                    last_irrigation_time = datetime.strptime(last_irrigation, "%Y-%m-%d %H:%M:%S")  
+                    last_irrigation_time = datetime.strptime(last_irrigation, "%Y-%m-%d %H:%M:%S")
                     time_difference = (current_time - last_irrigation_time).total_seconds() / 60  # Differenza in minuti
-                    if time_difference < 5:
-                        return  # Evita l'irrigazione se non sono trascorsi 5 minuti
+                    if time_difference < state["cooldown_minutes"]:
+                        continue  # Evita l'irrigazione se non è trascorso il cooldown del vaso
 
             except Exception as e:
                 print(f"Error retrieving last_irrigation for {smartpot_id}: {e}")
 
-            # **Se i 5 minuti sono passati, attiva l'irrigazione**
-            irrigation_msg = json.dumps({
-                "smartpot_id": smartpot_id
-            })
-            sqs.send_message(QueueUrl=SQS_IRRIGATION_QUEUE, MessageBody=irrigation_msg)
+            # **Se il cooldown è trascorso, attiva l'irrigazione**
+            outbox.add(SQS_IRRIGATION_QUEUE, {"smartpot_id": smartpot_id})
+            continue
 
-        elif soil_moisture_value > limits["soil_moisture_max"]:
-            # **Se il valore è troppo alto, invia un alert**
-            alert_msg = json.dumps({
-                "smartpot_id": smartpot_id,
-                "issue": "soil_moisture_high",
-                "details": {"soil_moisture": sensor_data.soil_moisture}
-            })
-            sqs.send_message(QueueUrl=SQS_ALERTS_QUEUE, MessageBody=alert_msg)
+        # **Macchina a stati degli alert: solo le transizioni generano messaggi**
+        try:
+            alerts = get_alert_state(smartpot_id)
+        except Exception as e:
+            print(f"Error retrieving alert_state for {smartpot_id}: {e}")
+            alerts = alert_states.setdefault(smartpot_id, {"alerts": {}, "cached_at": time.time()})["alerts"]
+
+        if breached:
+            last_alert = alerts.get(issue)
+            if last_alert is not None and now - last_alert < ALERT_REALERT_MINUTES * 60:
+                continue
+            alerts[issue] = now
+        elif breached is False and issue in alerts:
+            del alerts[issue]
+            issue = f"{issue}_resolved"
+        else:
+            continue
 
-    except ValueError:
-        print(f"Skipping soil moisture check for {smartpot_id}: Invalid value '{sensor_data.soil_moisture}'")
+        changed[smartpot_id] = alerts
+        outbox.add(SQS_ALERTS_QUEUE, {
+            "smartpot_id": smartpot_id,
+            "issue": issue,
+            "details": details
+        })
 
+    for smartpot_id, alerts in changed.items():
+        save_alert_state(smartpot_id, alerts)
 
 def lambda_handler(event, context):
     """AWS Lambda entry point that processes incoming sensor data from a Kinesis stream."""
     os.putenv("TZ", "Europe/Rome")
     time.tzset()
 
+    readings = []
+    summaries = []
     for record in event["Records"]:
         try:
             decoded_data = base64.b64decode(record["kinesis"]["data"]).decode("utf-8")
             json_data = json.loads(decoded_data)
 
-            sensor_data = SensorData(**json_data)
-            save_to_dynamodb(sensor_data)
-            save_to_s3(sensor_data)
-            check_and_trigger(sensor_data)
+            # **Riassunto edge: l'ultima lettura vale come lettura singola, le statistiche vanno negli aggregati**
+            if json_data.get("record_type") == "summary":
+                sensor_data = SensorData(
+                    smartpot_id=json_data["smartpot_id"],
+                    measure_date=json_data["measure_date"],
+                    measure_ts=json_data.get("measure_ts"),
+                    summarized=True,
+                    **{metric: str(json_data[metric]["last"]) for metric in METRICS}
+                )
+                summaries.append(json_data)
+            else:
+                sensor_data = SensorData(**json_data)
+            readings.append((record["kinesis"]["sequenceNumber"], sensor_data))
 
         except Exception as e:
             print(f"Error processing record: {e}")
+
+    # **Aggiornamento DynamoDB: solo l'ultima lettura di ogni vaso**
+    for sensor_data in get_latest_readings(readings):
+        save_to_dynamodb(sensor_data)
+
+    # **Alert e irrigazioni: raccolti per l'intero batch e inviati insieme**
+    # (minimi e massimi dei riassunti edge prima delle letture, così l'ultimo valore decide lo stato finale)
+    outbox = MessageOutbox()
+    try:
+        check_and_trigger(get_summary_extremes(summaries) + [sensor_data for _, sensor_data in readings], outbox)
+    except Exception as e:
+        print(f"Error checking thresholds: {e}")
+    outbox.flush()
+
+    # **Scrittura dei dati grezzi: un solo segmento per vaso per batch**
+    save_to_s3(readings)
+
+    # **Aggregati orari per i report (le ultime letture dei riassunti sono già incluse nelle loro statistiche)**
+    rollups = build_rollups([sensor_data for _, sensor_data in readings if not sensor_data.summarized])
+    merge_summary_rollups(rollups, summaries)
+    save_rollups(rollups)
@@ -0,0 +1,96 @@
+import argparse
+import boto3
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+# Test di scalabilità end-to-end del bridge MQTT -> Kinesis: per ogni numero di istanze avvia i bridge,
+# pubblica il carico con mqtt_load_generator.py e conta le letture effettivamente arrivate nella stream Kinesis.
+# Il generatore da solo misura solo il rate di pubblicazione, non quello del bridge.
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+BRIDGE_STARTUP = 5  # Secondi concessi ai bridge per connettersi prima del carico
+DRAIN_TIME = 15  # Secondi di attesa dopo il carico (finestre di assemblaggio e ultimi batch)
+
+def start_bridges(instances, args, run_id):
+    """Avvia instances processi del bridge che condividono la sottoscrizione."""
+    bridges = []
+    for instance_id in range(instances):
+        command = [sys.executable, os.path.join(SCRIPTS_DIR, "mqtt_to_kinesis.py"),
+                   "--broker", args.broker, "--port", str(args.port), "--quiet",
+                   "--instances", str(instances), "--instance-id", str(instance_id),
+                   "--group", f"bench-{run_id}", "--workers", str(args.workers),
+                   "--spool", os.path.join("spool", f"bench-{run_id}")]
+        bridges.append(subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    return bridges
+
+def run_load(args, prefix):
+    """Esegue il generatore di carico e restituisce il numero di letture pubblicate."""
+    command = [sys.executable, os.path.join(SCRIPTS_DIR, "mqtt_load_generator.py"),
+               "--broker", args.broker, "--port", str(args.port), "--pots", str(args.pots),
+               "--rate", str(args.rate), "--duration", str(args.duration), "--prefix", prefix]
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return int(re.search(r"Published (\d+) readings", output).group(1))
+
+def read_stream(kinesis_client, stream_name, since, prefix):
+    """Legge la stream dal momento since e restituisce gli istanti di arrivo delle letture dei vasi di prefix."""
+    arrivals = []
+    for shard in kinesis_client.list_shards(StreamName=stream_name)["Shards"]:
+        iterator = kinesis_client.get_shard_iterator(
+            StreamName=stream_name, ShardId=shard["ShardId"], ShardIteratorType="AT_TIMESTAMP", Timestamp=since
+        )["ShardIterator"]
+        while iterator:
+            response = kinesis_client.get_records(ShardIterator=iterator, Limit=10000)
+            for record in response["Records"]:
+                if json.loads(record["Data"]).get("smartpot_id", "").startswith(prefix):
+                    arrivals.append(record["ApproximateArrivalTimestamp"].timestamp())
+            if not response["Records"] and response.get("MillisBehindLatest", 0) == 0:
+                break
+            iterator = response.get("NextShardIterator")
+    return arrivals
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput end-to-end del bridge MQTT -> Kinesis al variare delle istanze")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--stream", default="SmartPotSensors")
+    parser.add_argument("--instances", default="1,2,4", help="numeri di istanze da provare, separati da virgola")
+    parser.add_argument("--workers", type=int, default=0, help="processi worker di ogni istanza")
+    parser.add_argument("--pots", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=5000, help="letture al secondo offerte (oltre il limite atteso del bridge)")
+    parser.add_argument("--duration", type=float, default=30)
+    args = parser.parse_args()
+
+    kinesis_client = boto3.client("kinesis", endpoint_url="http://localhost:4566", region_name="us-east-1")
+    results = []
+
+    for instances in [int(count) for count in args.instances.split(",")]:
+        run_id = f"{instances}-{int(time.time())}"
+        prefix = f"Bench{instances}x{int(time.time()) % 100000}P"
+        bridges = start_bridges(instances, args, run_id)
+        try:
+            time.sleep(BRIDGE_STARTUP)
+            since = datetime.now(timezone.utc)
+            published = run_load(args, prefix)
+            time.sleep(DRAIN_TIME)
+        finally:
+            for bridge in bridges:
+                bridge.terminate()
+                bridge.wait()
+
+        arrivals = read_stream(kinesis_client, args.stream, since, prefix)
+        elapsed = max(arrivals) - min(arrivals) if len(arrivals) > 1 else 0
+        throughput = len(arrivals) / elapsed if elapsed else 0
+        results.append((instances, published, len(arrivals), throughput))
+        print(f"{instances} instance(s): {len(arrivals)}/{published} readings in Kinesis, {throughput:.1f} readings/s end-to-end")
+
+    print("\ninstances  published  delivered  readings/s")
+    for instances, published, delivered, throughput in results:
+        print(f"{instances:>9}  {published:>9}  {delivered:>9}  {throughput:>10.1f}")
+
+if __name__ == "__main__":
+    main()
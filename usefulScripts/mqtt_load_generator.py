@@ -0,0 +1,52 @@
+import paho.mqtt.client as mqtt
+import argparse
+import json
+import random
+import time
+
+# Generatore di carico per il bridge MQTT -> Kinesis: simula molti vasi che pubblicano
+# le misure sugli stessi topic degli ESP32 (<smartpot_id>_Temp, _Hum, _Soil)
+
+def build_measures(smartpot_id):
+    """Restituisce i messaggi (topic, payload) di una lettura completa di un vaso"""
+    return [
+        (f"{smartpot_id}_Temp", json.dumps({"smartpot_id": smartpot_id, "temperature": f"{random.uniform(15, 30):.1f}"})),
+        (f"{smartpot_id}_Hum", json.dumps({"smartpot_id": smartpot_id, "humidity": f"{random.uniform(40, 80):.1f}"})),
+        (f"{smartpot_id}_Soil", json.dumps({"smartpot_id": smartpot_id, "soil_moisture": f"{random.uniform(30, 80):.1f}"}))
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description="Generatore di carico MQTT per il bridge dei SmartPot")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--pots", type=int, default=1000, help="numero di vasi simulati")
+    parser.add_argument("--rate", type=float, default=500, help="letture complete al secondo (3 messaggi ciascuna)")
+    parser.add_argument("--duration", type=float, default=60, help="durata del test in secondi")
+    parser.add_argument("--prefix", default="LoadPot", help="prefisso degli smartpot_id simulati")
+    args = parser.parse_args()
+
+    client = mqtt.Client()
+    client.connect(args.broker, args.port, 60)
+    client.loop_start()
+
+    pots = [f"{args.prefix}{index:05d}" for index in range(args.pots)]
+    start = time.monotonic()
+    sent = 0
+
+    # Pubblica le letture a rotazione tra i vasi, mantenendo il rate richiesto
+    while time.monotonic() - start < args.duration:
+        for topic, payload in build_measures(pots[sent % len(pots)]):
+            client.publish(topic, payload)
+        sent += 1
+
+        delay = start + sent / args.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    elapsed = time.monotonic() - start
+    client.loop_stop()
+    client.disconnect()
+    print(f"Published {sent} readings ({sent * 3} messages) in {elapsed:.1f}s: {sent / elapsed:.1f} readings/s")
+
+if __name__ == "__main__":
+    main()
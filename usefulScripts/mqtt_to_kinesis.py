@@ -1,75 +1,662 @@
 import paho.mqtt.client as mqtt
+import argparse
 import boto3
+import fcntl
 import json
+import mmap
+import multiprocessing
+import os
+import queue
+import struct
+import threading
 import time
 import datetime
+import zlib
+from collections import OrderedDict
 
-# Configura la connessione a Kinesis
-kinesis_client = boto3.client("kinesis", endpoint_url="http://localhost:4566", region_name="us-east-1")
+# Configura la connessione a Kinesis e S3 (i client vengono creati in ogni processo da start_pipeline)
+kinesis_client = None
+s3_client = None
 KINESIS_STREAM_NAME = "SmartPotSensors"
 
-# Dizionario per tenere traccia dei dati ricevuti
-sensor_data = {
-    "Strawberry": {"temperature": None, "humidity": None, "soil_moisture": None},
-    "Basil": {"temperature": None, "humidity": None, "soil_moisture": None},
-}
+# Limiti di put_records e parametri del batcher
+KINESIS_MAX_RECORDS = 500  # Record per chiamata put_records
+KINESIS_MAX_BYTES = 5 * 1024 * 1024  # Dimensione massima di una chiamata put_records
+BATCH_MAX_AGE = 1.0  # Secondi di attesa massima di un record prima dell'invio
+BATCH_QUEUE_SIZE = 10000  # Letture in coda prima di rallentare l'ingest MQTT (backpressure)
+RETRY_BASE_DELAY = 0.1  # Secondi, raddoppiati a ogni tentativo fallito
+RETRY_MAX_DELAY = 5.0
 
-# Funzione per inviare i dati a Kinesis
-def send_to_kinesis(smartpot_id):
-    """Invia i dati completi alla stream Kinesis"""
-    measure_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+# Spool su disco delle letture non inviate (file ad anello mappato in memoria, uno per processo)
+SPOOL_PATH = "spool/bridge"  # Prefisso dei file: <SPOOL_PATH>-<istanza>-<worker>.spool
+SPOOL_SIZE = 64 * 1024 * 1024  # Byte massimi occupati da ogni spool: oltre, le letture più vecchie vengono scartate
+SPOOL_SYNC_INTERVAL = 1.0  # Secondi tra due flush su disco
+
+# Finestre di assemblaggio delle letture
+ASSEMBLY_TIMEOUT = 10.0  # Secondi dopo la prima misura prima di inviare una lettura incompleta
+ASSEMBLY_MAX_POTS = 10000  # Finestre aperte contemporaneamente (oltre, la più vecchia viene inviata)
+SENSOR_TOPICS = {"_Temp": "temperature", "_Hum": "humidity", "_Soil": "soil_moisture"}
+
+# Scalabilità: istanze con sottoscrizione condivisa (MQTT v5) e processi worker
+MQTT_BROKER = "localhost"
+MQTT_PORT = 1883
+INSTANCES = 1  # Istanze del bridge che condividono la sottoscrizione
+INSTANCE_ID = 0
+SHARE_GROUP = "smartpot-bridge"
+ROUTE_PREFIX = "bridge/route/"  # bridge/route/<istanza>/<topic>: misure inoltrate all'istanza proprietaria del vaso
+WORKER_QUEUE_SIZE = 10000  # Messaggi in coda per ogni worker prima di rallentare l'ingest MQTT
+STATS_INTERVAL = 10  # Secondi tra due stampe del throughput
+VERBOSE = True  # Stampa ogni lettura inviata
+
+# Modalità edge: riassunti periodici per vaso al posto delle singole letture
+EDGE_INTERVAL = 0  # Secondi coperti da un riassunto (0: modalità disattivata)
+S3_BUCKET = "smartpotsystem-s3-bucket"
+PLANT_LIMITS_KEY = "config/plant_limits.json"  # Stessa configurazione letta da processSensorData
+PLANT_LIMITS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config", "plant_limits.json")  # Solo se S3 non risponde
+LIMITS_REFRESH_INTERVAL = 60  # Secondi tra due controlli dell'ETag della configurazione in S3
+METRICS = ["temperature", "humidity", "soil_moisture"]
+
+class DiskSpool:
+    """Coda FIFO persistente di record (partition_key, data) in un file ad anello mappato in memoria.
+       Il file ha una dimensione fissa (SPOOL_SIZE): quando è pieno i record più vecchi vengono scartati.
+       L'intestazione conserva testa, coda e numero di record, così dopo un riavvio il bridge
+       riprende a svuotare lo spool da dove si era fermato.
+       I record già inviati che seguono un record rifiutato restano al loro posto, marcati come inviati
+       (bit SENT della lunghezza della chiave), così quelli rifiutati restano in testa e l'ordine è mantenuto."""
+
+    MAGIC = b"SPL1"
+    HEADER = struct.Struct("<4sQQQQQ")  # magic, capacità, testa, coda, record, record scartati
+    HEADER_SIZE = 64
+    RECORD = struct.Struct("<IH")  # lunghezza dei dati, lunghezza della partition key
+    WRAP = 0xFFFFFFFF  # Marcatore di ritorno all'inizio dell'area dati
+    SENT = 0x8000  # Bit della lunghezza della chiave dei record già accettati da Kinesis
+
+    def __init__(self, path, capacity):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.removed = 0  # Record tolti dalla testa dall'apertura: indice del record in testa
+
+        # Il file resta aperto e bloccato: due processi sullo stesso spool ne corromperebbero l'anello
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self.fd)
+            raise RuntimeError(f"Spool {path} is already used by another bridge process (check --instance-id and --spool)")
+        if os.fstat(self.fd).st_size != self.HEADER_SIZE + capacity:
+            os.ftruncate(self.fd, self.HEADER_SIZE + capacity)
+        self.map = mmap.mmap(self.fd, self.HEADER_SIZE + capacity)
+
+        magic, stored_capacity, self.head, self.tail, self.count, self.dropped = self.HEADER.unpack_from(self.map)
+        if magic != self.MAGIC or stored_capacity != capacity:
+            self.capacity, self.head, self.tail, self.count, self.dropped = capacity, 0, 0, 0, 0
+            self.write_header()
+        else:
+            self.capacity = capacity
+            if self.count:
+                print(f"Resuming spool {path}: {self.count} readings to send")
+
+    def write_header(self):
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.capacity, self.head, self.tail, self.count, self.dropped)
+        self.dirty = True
+
+    def read_at(self, position):
+        """Legge il record che inizia in position (seguendo il ritorno all'inizio).
+           Restituisce ((partition_key, data), posizione effettiva, posizione del record successivo, già inviato)."""
+        if self.capacity - position < self.RECORD.size:
+            position = 0
+        else:
+            length, _ = self.RECORD.unpack_from(self.map, self.HEADER_SIZE + position)
+            if length == self.WRAP:
+                position = 0
+        length, key_length = self.RECORD.unpack_from(self.map, self.HEADER_SIZE + position)
+        sent = bool(key_length & self.SENT)
+        key_length &= ~self.SENT
+        start = self.HEADER_SIZE + position + self.RECORD.size
+        key = self.map[start:start + key_length].decode("utf-8")
+        data = self.map[start + key_length:start + key_length + length]
+        return (key, data), position, position + self.RECORD.size + key_length + length, sent
+
+    def remove_head(self):
+        """Toglie il record in testa. Restituisce True se non era ancora stato inviato."""
+        _, _, self.head, sent = self.read_at(self.head)
+        self.count -= 1
+        self.removed += 1
+        return not sent
+
+    def skip_sent(self):
+        """Toglie dalla testa i record già inviati."""
+        while self.count and self.read_at(self.head)[3]:
+            self.remove_head()
+
+    def fits(self, size):
+        """Restituisce la posizione in cui scrivere un record di size byte, o None se non c'è spazio."""
+        if self.count == 0:
+            self.head = self.tail = 0
+            return 0 if size <= self.capacity else None
+        if self.tail == self.head:
+            return None  # Pieno
+        if self.tail > self.head:
+            if size <= self.capacity - self.tail:
+                return self.tail
+            return 0 if size <= self.head else None
+        return self.tail if size <= self.head - self.tail else None
+
+    def append(self, records):
+        """Aggiunge dei record in coda, scartando i più vecchi se lo spool è pieno."""
+        with self.lock:
+            for key, data in records:
+                encoded_key = key.encode("utf-8")
+                size = self.RECORD.size + len(encoded_key) + len(data)
+                if size > self.capacity:
+                    print(f"Reading of {key} too large for the spool. Dropped.")
+                    continue
+
+                position = self.fits(size)
+                while position is None:
+                    if self.remove_head():
+                        self.dropped += 1
+                    self.skip_sent()
+                    position = self.fits(size)
+
+                if position == 0 and self.tail != 0 and self.capacity - self.tail >= 4:
+                    struct.pack_into("<I", self.map, self.HEADER_SIZE + self.tail, self.WRAP)
+                offset = self.HEADER_SIZE + position
+                self.RECORD.pack_into(self.map, offset, len(data), len(encoded_key))
+                offset += self.RECORD.size
+                self.map[offset:offset + len(encoded_key)] = encoded_key
+                self.map[offset + len(encoded_key):offset + size - self.RECORD.size] = data
+                self.tail = position + size
+                self.count += 1
+            self.write_header()
+
+    def peek(self, max_records, max_bytes):
+        """Restituisce i primi record non ancora inviati dello spool (al massimo max_records e max_bytes)
+           senza rimuoverli, come coppie (indice, record) da passare poi a complete()."""
+        with self.lock:
+            entries, size, position = [], 0, self.head
+            for index in range(self.removed, self.removed + self.count):
+                if len(entries) >= max_records:
+                    break
+                record, _, next_position, sent = self.read_at(position)
+                position = next_position
+                if sent:
+                    continue
+                record_size = len(record[0]) + len(record[1])
+                if entries and size + record_size > max_bytes:
+                    break
+                entries.append((index, record))
+                size += record_size
+            return entries
+
+    def complete(self, indexes, accepted):
+        """Registra l'esito dell'invio dei record restituiti da peek().
+           I record accettati in testa vengono rimossi; quelli accettati dopo il primo rifiutato vengono
+           marcati come inviati. I record scartati nel frattempo da append() (spool pieno) hanno indici
+           già superati dalla testa e vengono ignorati, così non si rimuovono mai record non inviati."""
+        with self.lock:
+            outcome = dict(zip(indexes, accepted))
+            last = max(indexes, default=-1)
+            position, index, removing = self.head, self.removed, True
+            while index <= last and index < self.removed + self.count:
+                _, start, next_position, sent = self.read_at(position)
+                if removing and (sent or outcome.get(index)):
+                    self.remove_head()
+                elif outcome.get(index):
+                    _, key_length = self.RECORD.unpack_from(self.map, self.HEADER_SIZE + start)
+                    struct.pack_into("<H", self.map, self.HEADER_SIZE + start + 4, key_length | self.SENT)
+                else:
+                    removing = False
+                position, index = next_position, index + 1
+            self.skip_sent()
+            self.write_header()
+
+    def sync(self):
+        """Scrive su disco le modifiche dello spool."""
+        with self.lock:
+            if self.dirty:
+                self.map.flush()
+                self.dirty = False
+
+class KinesisBatcher:
+    """Invia le letture a Kinesis in background con put_records.
+       Le letture vengono accodate da put() in una coda limitata: se la coda è piena put() attende,
+       così l'ingest rallenta invece di far crescere la memoria.
+       Un batch parte quando raggiunge KINESIS_MAX_RECORDS record, KINESIS_MAX_BYTES byte
+       o quando il record più vecchio ha atteso BATCH_MAX_AGE secondi.
+       I record che Kinesis non accetta (errori o fallimenti parziali) finiscono nello spool su disco;
+       finché lo spool non è vuoto anche i nuovi batch vi vengono aggiunti, per mantenere l'ordine.
+       Un secondo thread svuota lo spool nell'ordine di arrivo, con un ritardo esponenziale tra i tentativi."""
+
+    def __init__(self, stream_name, spool_path):
+        self.stream_name = stream_name
+        self.queue = queue.Queue(maxsize=BATCH_QUEUE_SIZE)
+        self.pending = []  # Record (partition_key, data) del batch corrente
+        self.spool = DiskSpool(spool_path, SPOOL_SIZE)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.drainer = threading.Thread(target=self.drain, daemon=True)
+        self.drainer.start()
+
+    def put(self, partition_key, data):
+        """Accoda un record; attende se la coda è piena."""
+        self.queue.put((partition_key, data.encode("utf-8")))
+
+    def fill_batch(self):
+        """Aggiunge record al batch fino ai limiti di put_records o alla scadenza di BATCH_MAX_AGE."""
+        size = 0
+        deadline = time.monotonic() + BATCH_MAX_AGE
+        while len(self.pending) < KINESIS_MAX_RECORDS:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                # Senza record in attesa si aspetta il primo senza limite di tempo
+                record = self.queue.get(timeout=timeout if self.pending else None)
+            except queue.Empty:
+                break
+            if not self.pending:
+                deadline = time.monotonic() + BATCH_MAX_AGE
+            record_size = len(record[0]) + len(record[1])
+            if self.pending and size + record_size > KINESIS_MAX_BYTES:
+                self.flush()
+                size = 0
+            self.pending.append(record)
+            size += record_size
+
+    def send(self, batch):
+        """Invia un batch con put_records. Restituisce per ogni record se Kinesis lo ha accettato."""
+        response = kinesis_client.put_records(
+            StreamName=self.stream_name,
+            Records=[{"PartitionKey": key, "Data": bytes(data)} for key, data in batch]
+        )
+        return ["ErrorCode" not in result for result in response["Records"]]
+
+    def flush(self):
+        """Invia il batch corrente; i record non inviati vengono scritti nello spool."""
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        if self.spool.count:
+            self.spool.append(batch)  # Lo spool va svuotato prima, nell'ordine
+            return
+
+        try:
+            failed = [record for record, accepted in zip(batch, self.send(batch)) if not accepted]
+            if failed:
+                print(f"Kinesis rejected {len(failed)} of {len(batch)} records. Spooling...")
+            else:
+                print(f"Sent {len(batch)} records to Kinesis")
+        except Exception as e:
+            print(f"Error sending to Kinesis: {e}. Spooling {len(batch)} records...")
+            failed = batch
+        self.spool.append(failed)
+
+    def run(self):
+        """Ciclo del thread di invio."""
+        while True:
+            try:
+                self.fill_batch()
+                self.flush()
+            except Exception as e:
+                print(f"Error in Kinesis batcher: {e}")
+
+    def drain(self):
+        """Ciclo del thread che reinvia i record dello spool, dal più vecchio."""
+        retry_delay = 0
+        synced_at = time.monotonic()
+        while True:
+            try:
+                if time.monotonic() - synced_at >= SPOOL_SYNC_INTERVAL:
+                    self.spool.sync()
+                    synced_at = time.monotonic()
+
+                entries = self.spool.peek(KINESIS_MAX_RECORDS, KINESIS_MAX_BYTES)
+                if not entries:
+                    time.sleep(SPOOL_SYNC_INTERVAL)
+                    continue
+                if retry_delay:
+                    time.sleep(retry_delay)
+
+                try:
+                    accepted = self.send([record for _, record in entries])
+                except Exception as e:
+                    print(f"Error replaying spool to Kinesis: {e}")
+                    retry_delay = min(RETRY_MAX_DELAY, max(RETRY_BASE_DELAY, retry_delay * 2))
+                    continue
+
+                # I record rifiutati restano in testa allo spool, nell'ordine
+                self.spool.complete([index for index, _ in entries], accepted)
+                print(f"Replayed {sum(accepted)} spooled records ({self.spool.count} left)")
+                retry_delay = 0 if all(accepted) else min(RETRY_MAX_DELAY, max(RETRY_BASE_DELAY, retry_delay * 2))
+
+            except Exception as e:
+                print(f"Error in spool drainer: {e}")
+                time.sleep(RETRY_MAX_DELAY)
+
+class ReadingWindow:
+    """Misure di un vaso in attesa di formare una lettura completa."""
+    __slots__ = ("smartpot_id", "opened", "temperature", "humidity", "soil_moisture")
+
+    def __init__(self, smartpot_id):
+        self.smartpot_id = smartpot_id
+        self.opened = time.monotonic()
+        self.temperature = None
+        self.humidity = None
+        self.soil_moisture = None
+
+    def is_complete(self):
+        return self.temperature is not None and self.humidity is not None and self.soil_moisture is not None
+
+class ReadingAssembler:
+    """Assembla le misure di temperatura, umidità e umidità del suolo di ogni vaso in una lettura.
+       I vasi si registrano automaticamente alla prima misura ricevuta.
+       Una finestra viene inviata appena è completa oppure ASSEMBLY_TIMEOUT secondi dopo la prima misura,
+       con "ERR" al posto delle misure mancanti (un sensore guasto non blocca più il vaso).
+       Le finestre sono al massimo ASSEMBLY_MAX_POTS: oltre il limite la più vecchia viene inviata subito."""
+
+    def __init__(self, emit):
+        self.emit = emit
+        self.emitted = 0
+        self.windows = OrderedDict()  # smartpot_id -> ReadingWindow, in ordine di apertura
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, smartpot_id, field, value):
+        """Registra una misura; invia la lettura se la finestra del vaso è completa."""
+        with self.lock:
+            window = self.windows.get(smartpot_id)
+            if window is None:
+                window = self.windows[smartpot_id] = ReadingWindow(smartpot_id)
+                while len(self.windows) > ASSEMBLY_MAX_POTS:
+                    self.flush(self.windows.popitem(last=False)[1])
+            setattr(window, field, value)
+            if window.is_complete():
+                del self.windows[smartpot_id]
+                self.flush(window)
 
-    kinesis_payload = json.dumps({
+    def flush(self, window):
+        """Invia una finestra, segnando come "ERR" le misure mancanti."""
+        self.emitted += 1
+        self.emit(
+            window.smartpot_id,
+            "ERR" if window.temperature is None else window.temperature,
+            "ERR" if window.humidity is None else window.humidity,
+            "ERR" if window.soil_moisture is None else window.soil_moisture
+        )
+
+    def expire(self):
+        """Invia le finestre aperte da più di ASSEMBLY_TIMEOUT secondi."""
+        deadline = time.monotonic() - ASSEMBLY_TIMEOUT
+        with self.lock:
+            while self.windows:
+                window = next(iter(self.windows.values()))
+                if window.opened > deadline:
+                    break
+                del self.windows[window.smartpot_id]
+                self.flush(window)
+
+    def run(self):
+        """Ciclo del thread che chiude le finestre scadute e stampa il throughput."""
+        stats_time, stats_count = time.monotonic(), 0
+        while True:
+            time.sleep(min(1.0, ASSEMBLY_TIMEOUT / 4))
+            try:
+                self.expire()
+            except Exception as e:
+                print(f"Error expiring reading windows: {e}")
+
+            elapsed = time.monotonic() - stats_time
+            if elapsed >= STATS_INTERVAL:
+                emitted = self.emitted
+                if emitted > stats_count:
+                    print(f"Assembled {(emitted - stats_count) / elapsed:.1f} readings/s ({len(self.windows)} open windows)")
+                stats_time, stats_count = time.monotonic(), emitted
+
+class EdgeAggregator:
+    """Riassume le letture di ogni vaso su intervalli di EDGE_INTERVAL secondi (modalità edge).
+       Per ogni misura tiene conteggio, somma, minimo, massimo, somma dei quadrati e ultimo valore;
+       a fine intervallo (o al cambio d'ora, perché i riassunti finiscono negli aggregati orari)
+       invia un record "summary" al posto delle singole letture.
+       Le letture con "ERR", fuori dai limiti della pianta o di vasi senza limiti configurati vengono
+       invece inviate subito, così alert e irrigazioni non subiscono ritardi.
+       I limiti sono quelli della configurazione in S3 usata da processSensorData, ricaricata quando
+       cambia il suo ETag; il file locale serve solo finché S3 non risponde."""
+
+    def __init__(self, fallback_config):
+        self.limits_version = None
+        self.set_limits(fallback_config)
+        self.refresh_limits()
+        self.windows = {}  # smartpot_id -> riassunto in corso
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def set_limits(self, limits_config):
+        """Sostituisce i limiti in uso (con un'unica assegnazione, letta senza lock dal thread MQTT)."""
+        self.limits = (limits_config.get("species", {}), limits_config.get("pots", {}), limits_config.get("default", {}))
+
+    def refresh_limits(self):
+        """Ricarica la configurazione dei limiti da S3 se il suo ETag è cambiato."""
+        try:
+            head = s3_client.head_object(Bucket=S3_BUCKET, Key=PLANT_LIMITS_KEY)
+            if head["ETag"] != self.limits_version:
+                obj = s3_client.get_object(Bucket=S3_BUCKET, Key=PLANT_LIMITS_KEY)
+                self.set_limits(json.loads(obj["Body"].read().decode("utf-8")))
+                self.limits_version = obj["ETag"]
+                print(f"Loaded plant limits configuration {PLANT_LIMITS_KEY} (version {obj['ETag']})")
+        except Exception as e:
+            print(f"Error loading plant limits from S3: {e}")
+
+    def get_limits(self, smartpot_id):
+        """Limiti del vaso, risolti come in processSensorData: vaso, specie, default."""
+        species, pots, default = self.limits
+        pot_config = pots.get(smartpot_id, {})
+        limits = dict(species.get(pot_config.get("species", smartpot_id), default))
+        limits.update({key: value for key, value in pot_config.items() if key != "species"})
+        return limits
+
+    def is_regular(self, smartpot_id, values):
+        """Vero se il vaso ha dei limiti e tutti i valori sono numerici e dentro i limiti."""
+        limits = self.get_limits(smartpot_id)
+        if not limits:
+            return False
+        for metric, value in zip(METRICS, values):
+            if value is None:
+                return False
+            if f"{metric}_min" in limits and value < float(limits[f"{metric}_min"]):
+                return False
+            if f"{metric}_max" in limits and value > float(limits[f"{metric}_max"]):
+                return False
+        return True
+
+    def add(self, smartpot_id, temperature, humidity, soil_moisture):
+        """Aggiunge una lettura al riassunto del vaso, o la invia subito se anomala."""
+        now = datetime.datetime.now()
+        readings = (temperature, humidity, soil_moisture)
+        try:
+            values = [float(value) for value in readings]
+        except (TypeError, ValueError):
+            values = [None] * len(METRICS)
+
+        if not self.is_regular(smartpot_id, values):
+            send_reading(smartpot_id, now, temperature, humidity, soil_moisture)
+            return
+
+        with self.lock:
+            window = self.windows.get(smartpot_id)
+            if window is not None and window["end"].hour != now.hour:
+                self.flush(smartpot_id, self.windows.pop(smartpot_id))
+                window = None
+            if window is None:
+                window = self.windows[smartpot_id] = {"start": now, "opened": time.monotonic()}
+                for metric in METRICS:
+                    window[metric] = [0, 0.0, None, None, 0.0]
+
+            window["end"] = now
+            window["last"] = readings
+            for metric, value in zip(METRICS, values):
+                stats = window[metric]
+                stats[0] += 1
+                stats[1] += value
+                stats[2] = value if stats[2] is None else min(stats[2], value)
+                stats[3] = value if stats[3] is None else max(stats[3], value)
+                stats[4] += value * value
+
+    def flush(self, smartpot_id, window):
+        """Invia il riassunto di un vaso."""
+        summary = {
+            "record_type": "summary",
+            "smartpot_id": smartpot_id,
+            "measure_date": window["end"].strftime("%Y-%m-%d %H:%M:%S"),
+            "measure_ts": int(window["end"].timestamp()),
+            "start": window["start"].strftime("%Y-%m-%d %H:%M:%S")
+        }
+        for metric, last in zip(METRICS, window["last"]):
+            count, total, minimum, maximum, sum_sq = window[metric]
+            summary[metric] = {
+                "count": count, "mean": total / count, "min": minimum, "max": maximum,
+                "last": last, "sum_sq": sum_sq
+            }
+        queue_record(smartpot_id, json.dumps(summary))
+
+    def run(self):
+        """Ciclo del thread che invia i riassunti degli intervalli scaduti e ricarica i limiti."""
+        checked_at = time.monotonic()
+        while True:
+            time.sleep(min(1.0, EDGE_INTERVAL / 4))
+            if time.monotonic() - checked_at >= LIMITS_REFRESH_INTERVAL:
+                self.refresh_limits()
+                checked_at = time.monotonic()
+            deadline = time.monotonic() - EDGE_INTERVAL
+            try:
+                with self.lock:
+                    for smartpot_id in [key for key, window in self.windows.items() if window["opened"] <= deadline]:
+                        self.flush(smartpot_id, self.windows.pop(smartpot_id))
+            except Exception as e:
+                print(f"Error sending edge summaries: {e}")
+
+def queue_record(smartpot_id, kinesis_payload):
+    """Accoda un record per l'invio alla stream Kinesis"""
+    if VERBOSE:
+        print(f"Queueing for Kinesis: {kinesis_payload}")
+    batcher.put(smartpot_id, kinesis_payload)
+
+def send_reading(smartpot_id, measure_date, temperature, humidity, soil_moisture):
+    """Accoda una singola lettura per l'invio alla stream Kinesis"""
+    queue_record(smartpot_id, json.dumps({
         "smartpot_id": smartpot_id,
-        "measure_date": measure_date,
-        "temperature": sensor_data[smartpot_id]["temperature"],
-        "humidity": sensor_data[smartpot_id]["humidity"],
-        "soil_moisture": sensor_data[smartpot_id]["soil_moisture"]
-    })
+        "measure_date": measure_date.strftime("%Y-%m-%d %H:%M:%S"),
+        "measure_ts": int(measure_date.timestamp()),  # Secondi dall'epoch (UTC), indipendente dal fuso del bridge
+        "temperature": temperature,
+        "humidity": humidity,
+        "soil_moisture": soil_moisture
+    }))
 
-    print(f"Sending to Kinesis: {kinesis_payload}")
-    try:
-        kinesis_client.put_record(StreamName=KINESIS_STREAM_NAME, PartitionKey=smartpot_id, Data=kinesis_payload)
-    except Exception as e:
-        print(f"Error sending to Kinesis: {e}")
+# Funzione per inviare i dati a Kinesis
+def send_to_kinesis(smartpot_id, temperature, humidity, soil_moisture):
+    """Invia una lettura completa: al riassunto del vaso in modalità edge, altrimenti direttamente a Kinesis"""
+    if edge is not None:
+        edge.add(smartpot_id, temperature, humidity, soil_moisture)
+    else:
+        send_reading(smartpot_id, datetime.datetime.now(), temperature, humidity, soil_moisture)
+
+batcher = None
+assembler = None
+edge = None
+worker_queues = []  # Code dei processi worker (modalità --workers)
+
+def start_pipeline(worker_id=0):
+    """Crea il client Kinesis, il batcher (con il proprio spool), l'aggregatore edge (se attivo)
+       e l'assembler del processo corrente."""
+    global kinesis_client, s3_client, batcher, assembler, edge
+    kinesis_client = boto3.client("kinesis", endpoint_url="http://localhost:4566", region_name="us-east-1")
+    batcher = KinesisBatcher(KINESIS_STREAM_NAME, f"{SPOOL_PATH}-{INSTANCE_ID}-{worker_id}.spool")
+    if EDGE_INTERVAL > 0:
+        s3_client = boto3.client("s3", endpoint_url="http://localhost:4566", region_name="us-east-1")
+        fallback_config = {}
+        if os.path.exists(PLANT_LIMITS_PATH):
+            with open(PLANT_LIMITS_PATH) as limits_file:
+                fallback_config = json.load(limits_file)
+        edge = EdgeAggregator(fallback_config)
+    assembler = ReadingAssembler(send_to_kinesis)
+
+def get_owner(topic, count, salt=1):
+    """Indice (tra count) dell'istanza o del worker a cui appartiene il vaso di un topic di misura.
+       Tutte le misure di un vaso finiscono così nello stesso processo, che ne tiene la finestra.
+       salt separa l'hash dei worker da quello delle istanze, che altrimenti sarebbero correlati."""
+    return (zlib.crc32(topic[:topic.rfind("_")].encode("utf-8")) // salt) % count
+
+def handle_measure(topic, payload):
+    """Decodifica una misura e la aggiunge alla finestra del suo vaso."""
+    suffix = topic[topic.rfind("_"):]
+    field = SENSOR_TOPICS[suffix]
+    data = json.loads(payload.decode("utf-8"))
+    smartpot_id = data.get("smartpot_id") or topic[:-len(suffix)]
+    assembler.add(smartpot_id, field, data[field])
 
-    # Reset dati per il prossimo ciclo
-    sensor_data[smartpot_id] = {"temperature": None, "humidity": None, "soil_moisture": None}
+def apply_settings(settings):
+    """Applica al processo corrente le opzioni della riga di comando.
+       I worker le ricevono esplicitamente: con i metodi di avvio spawn (macOS) e forkserver
+       (Linux da Python 3.14) il modulo viene reimportato e non eredita i valori impostati da main()."""
+    globals().update(settings)
+
+def run_worker(worker_id, work_queue, settings):
+    """Processo worker: assembla e invia a Kinesis le misure dei vasi assegnati."""
+    apply_settings(settings)
+    start_pipeline(worker_id)
+    while True:
+        topic, payload = work_queue.get()
+        try:
+            handle_measure(topic, payload)
+        except Exception as e:
+            print(f"Error processing MQTT message: {e}")
 
 # Funzione callback quando si riceve un messaggio
 def on_message(client, userdata, message):
     try:
-        payload = json.loads(message.payload.decode("utf-8"))
-        smartpot_id = payload["smartpot_id"]
+        topic = message.topic
+        if topic.startswith(ROUTE_PREFIX):
+            topic = topic[len(ROUTE_PREFIX):].split("/", 1)[1]  # Misura inoltrata da un'altra istanza
+
+        if SENSOR_TOPICS.get(topic[topic.rfind("_"):]) is None:
+            return  # Topic non di misura (es. Irrigation_Command)
 
-        if message.topic.endswith("_Temp"):
-            sensor_data[smartpot_id]["temperature"] = payload["temperature"]
-        elif message.topic.endswith("_Hum"):
-            sensor_data[smartpot_id]["humidity"] = payload["humidity"]
-        elif message.topic.endswith("_Soil"):
-            sensor_data[smartpot_id]["soil_moisture"] = payload["soil_moisture"]
+        # Con la sottoscrizione condivisa il broker distribuisce i messaggi senza affinità:
+        # le misure dei vasi di altre istanze vengono inoltrate alla proprietaria
+        if INSTANCES > 1 and topic == message.topic:
+            owner = get_owner(topic, INSTANCES)
+            if owner != INSTANCE_ID:
+                client.publish(f"{ROUTE_PREFIX}{owner}/{topic}", message.payload, qos=message.qos)
+                return
 
-        # Se tutti i valori sono disponibili, invia a Kinesis
-        if None not in sensor_data[smartpot_id].values():
-            send_to_kinesis(smartpot_id)
+        if worker_queues:
+            worker_queues[get_owner(topic, len(worker_queues), INSTANCES)].put((topic, message.payload))
+        else:
+            handle_measure(topic, message.payload)
 
     except Exception as e:
         print(f"Error processing MQTT message: {e}")
 
 # Funzione callback per la connessione al broker MQTT
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
         print("Connected to MQTT Broker")
-        # Sottoscrizione ai topic per entrambi i vasi
-        for plant in ["Strawberry", "Basil"]:
-            client.subscribe(f"{plant}_Temp")
-            client.subscribe(f"{plant}_Hum")
-            client.subscribe(f"{plant}_Soil")
+        # Sottoscrizione ai topic di tutti i vasi: i filtri MQTT non accettano wildcard parziali
+        # come "+_Temp", quindi si sottoscrive "+" e si smista in base al suffisso del topic
+        if INSTANCES > 1:
+            client.subscribe(f"$share/{SHARE_GROUP}/+")
+            client.subscribe(f"{ROUTE_PREFIX}{INSTANCE_ID}/#")
+        else:
+            client.subscribe("+")
     else:
         print(f"Connection failed with result code {rc}")
 
 # Funzione callback per gestire disconnessioni
-def on_disconnect(client, userdata, rc):
+def on_disconnect(client, userdata, rc, properties=None):
     print("Disconnected from MQTT Broker. Attempting to reconnect...")
     while True:
         try:
@@ -80,18 +667,55 @@ def on_disconnect(client, userdata, rc):
             print(f"Reconnection failed: {e}. Retrying in 5 seconds...")
             time.sleep(5)
 
-# Configura il client MQTT
-client = mqtt.Client()
-client.on_connect = on_connect
-client.on_message = on_message
-client.on_disconnect = on_disconnect
+def main():
+    parser = argparse.ArgumentParser(description="Bridge MQTT -> Kinesis dei SmartPot")
+    parser.add_argument("--broker", default=MQTT_BROKER)
+    parser.add_argument("--port", type=int, default=MQTT_PORT)
+    parser.add_argument("--instances", type=int, default=INSTANCES,
+                        help="istanze del bridge che condividono la sottoscrizione $share/<group>/+ (MQTT v5)")
+    parser.add_argument("--instance-id", type=int, default=INSTANCE_ID, help="indice di questa istanza (0..instances-1)")
+    parser.add_argument("--group", default=SHARE_GROUP, help="nome del gruppo della sottoscrizione condivisa")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="processi worker che assemblano e inviano le letture (0: tutto nel processo MQTT)")
+    parser.add_argument("--quiet", action="store_true", help="non stampa ogni lettura, solo il throughput")
+    parser.add_argument("--spool", default=SPOOL_PATH, help="prefisso dei file di spool delle letture non inviate")
+    parser.add_argument("--edge-interval", type=float, default=EDGE_INTERVAL,
+                        help="modalità edge: secondi coperti da ogni riassunto per vaso (0: invia ogni lettura)")
+    parser.add_argument("--limits", default=PLANT_LIMITS_PATH,
+                        help="limiti delle piante usati in modalità edge finché la configurazione in S3 non è disponibile")
+    args = parser.parse_args()
 
-# Loop per mantenere il client sempre in ascolto
-while True:
-    try:
-        print("Connecting to MQTT Broker...")
-        client.connect("localhost", 1883, 60)
-        client.loop_forever()
-    except Exception as e:
-        print(f"Connection error: {e}. Retrying in 5 seconds...")
-        time.sleep(5)
+    settings = {
+        "INSTANCES": args.instances, "INSTANCE_ID": args.instance_id, "SHARE_GROUP": args.group,
+        "MQTT_BROKER": args.broker, "MQTT_PORT": args.port, "VERBOSE": not args.quiet, "SPOOL_PATH": args.spool,
+        "EDGE_INTERVAL": args.edge_interval, "PLANT_LIMITS_PATH": args.limits
+    }
+    apply_settings(settings)
+
+    # Avvia i worker (ognuno con il proprio assembler e batcher) oppure la pipeline locale
+    if args.workers > 0:
+        for worker_id in range(args.workers):
+            work_queue = multiprocessing.Queue(maxsize=WORKER_QUEUE_SIZE)
+            multiprocessing.Process(target=run_worker, args=(worker_id, work_queue, settings), daemon=True).start()
+            worker_queues.append(work_queue)
+    else:
+        start_pipeline()
+
+    # Configura il client MQTT (v5 per la sottoscrizione condivisa)
+    client = mqtt.Client(protocol=mqtt.MQTTv5 if INSTANCES > 1 else mqtt.MQTTv311)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.on_disconnect = on_disconnect
+
+    # Loop per mantenere il client sempre in ascolto
+    while True:
+        try:
+            print("Connecting to MQTT Broker...")
+            client.connect(MQTT_BROKER, MQTT_PORT, 60)
+            client.loop_forever()
+        except Exception as e:
+            print(f"Connection error: {e}. Retrying in 5 seconds...")
+            time.sleep(5)
+
+if __name__ == "__main__":
+    main()